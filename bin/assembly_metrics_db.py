@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+"""
+SQLite warehouse of the per-sample assembly metrics written by
+multiqc_to_custom_csv.py, accumulated across runs, and a small query CLI.
+
+Each (sample, run_id) has one row, re-running a run replaces its rows.
+"""
+
+import sys
+import argparse
+import sqlite3
+from datetime import date
+
+## Columns of the metrics table, by the MultiQC field (tag path) they come from
+METRIC_COLUMNS = {
+    ("before_filtering", "total_reads"): ("input_short_reads", "INTEGER"),
+    ("after_filtering", "total_reads"): ("trimmed_short_reads", "INTEGER"),
+    ("Number of reads_fastq",): ("input_long_reads", "INTEGER"),
+    ("Median read length_fastq",): ("median_long_read_length", "REAL"),
+    ("Median read quality_fastq",): ("median_long_read_quality", "REAL"),
+    ("# contigs",): ("contigs", "INTEGER"),
+    ("Largest contig",): ("largest_contig", "INTEGER"),
+    ("N50",): ("n50", "INTEGER"),
+    ("Genome fraction (%)",): ("genome_fraction", "REAL"),
+    ("07-kmerfinder_best_hit_Species",): ("best_hit_species", "TEXT"),
+    ("07-kmerfinder_best_hit_# Assembly",): ("best_hit_assembly", "TEXT"),
+    ("07-kmerfinder_best_hit_Query_Coverage",): ("best_hit_query_coverage", "REAL"),
+    ("07-kmerfinder_best_hit_Depth",): ("best_hit_depth", "REAL"),
+    ("07-kmerfinder_second_hit_Species",): ("second_hit_species", "TEXT"),
+    ("07-kmerfinder_second_hit_# Assembly",): ("second_hit_assembly", "TEXT"),
+    ("07-kmerfinder_second_hit_Query_Coverage",): (
+        "second_hit_query_coverage",
+        "REAL",
+    ),
+    ("07-kmerfinder_second_hit_Depth",): ("second_hit_depth", "REAL"),
+}
+
+KEY_COLUMNS = [
+    ("sample", "TEXT NOT NULL"),
+    ("run_id", "TEXT NOT NULL"),
+    ("run_date", "TEXT NOT NULL"),
+    ("assembly_type", "TEXT"),
+]
+
+
+def parse_args(args=None):
+    Description = "Query the assembly metrics accumulated across runs by multiqc_to_custom_csv.py --metrics_db."
+    Epilog = "Example usage: python assembly_metrics_db.py -db metrics.sqlite -species 'Escherichia coli' -since 2024-01-01 -group_by best_hit_species -metric n50"
+    parser = argparse.ArgumentParser(description=Description, epilog=Epilog)
+    parser.add_argument(
+        "-db", "--metrics_db", dest="METRICS_DB", required=True, help="SQLite file."
+    )
+    parser.add_argument("-sample", dest="SAMPLE", help="Only this sample.")
+    parser.add_argument(
+        "-species", dest="SPECIES", help="Only samples with this Kmerfinder best hit."
+    )
+    parser.add_argument(
+        "-since", dest="SINCE", help="Only runs from this date on (YYYY-MM-DD)."
+    )
+    parser.add_argument(
+        "-until", dest="UNTIL", help="Only runs up to this date (YYYY-MM-DD)."
+    )
+    parser.add_argument(
+        "-group_by",
+        dest="GROUP_BY",
+        choices=["best_hit_species", "run_date", "run_id", "assembly_type"],
+        help="Summarise -metric per group instead of listing the rows.",
+    )
+    parser.add_argument(
+        "-metric",
+        dest="METRIC",
+        default="n50",
+        choices=[c for c, t in METRIC_COLUMNS.values() if t != "TEXT"],
+        help="Metric summarised with -group_by (default: n50).",
+    )
+    parser.add_argument(
+        "-sql", dest="SQL", help="Run this read-only query instead, printing its rows."
+    )
+    return parser.parse_args(args)
+
+
+def open_db(db_file):
+    conn = sqlite3.connect(db_file, timeout=60)
+    columns = KEY_COLUMNS + list(METRIC_COLUMNS.values())
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS assembly_metrics ({}, PRIMARY KEY (sample, run_id))".format(
+            ", ".join('"{}" {}'.format(c, t) for c, t in columns)
+        )
+    )
+    for column in ["sample", "best_hit_species", "run_date"]:
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS assembly_metrics_{0} ON assembly_metrics ({0})".format(
+                column
+            )
+        )
+    return conn
+
+
+# Value of a metrics table cell in the column type, None when missing
+def typed_value(value, column_type):
+    if value is None or value == "" or value == "NA":
+        return None
+    try:
+        if column_type == "INTEGER":
+            return int(float(value))
+        if column_type == "REAL":
+            return float(value)
+    except (TypeError, ValueError):
+        return None
+    return str(value)
+
+
+def upsert_metrics(
+    db_file, metrics_dict, file_field_list, run_id, run_date=None, assembly_type=None
+):
+    """
+    Inserts or replaces the rows of metrics_dict (sample: {field: value}) built
+    by metrics_dict_to_file() from file_field_list
+    """
+    run_date = run_date or date.today().isoformat()
+    fields = [
+        (field, METRIC_COLUMNS[tuple(tags)])
+        for _, mapping_list in file_field_list
+        for field, tags in mapping_list
+        if tuple(tags) in METRIC_COLUMNS
+    ]
+    columns = [c for c, _ in KEY_COLUMNS] + [c for _, (c, _) in fields]
+    statement = "INSERT OR REPLACE INTO assembly_metrics ({}) VALUES ({})".format(
+        ", ".join('"{}"'.format(c) for c in columns), ", ".join("?" * len(columns))
+    )
+    conn = open_db(db_file)
+    try:
+        with conn:
+            conn.executemany(
+                statement,
+                (
+                    [str(sample), run_id, run_date, assembly_type]
+                    + [typed_value(values.get(field), t) for field, (_, t) in fields]
+                    for sample, values in metrics_dict.items()
+                ),
+            )
+    finally:
+        conn.close()
+
+
+def query_metrics(conn, args):
+    where, params = [], []
+    for column, op, value in [
+        ("sample", "=", args.SAMPLE),
+        ("best_hit_species", "=", args.SPECIES),
+        ("run_date", ">=", args.SINCE),
+        ("run_date", "<=", args.UNTIL),
+    ]:
+        if value is not None:
+            where.append("{} {} ?".format(column, op))
+            params.append(value)
+    where = " WHERE " + " AND ".join(where) if where else ""
+    if args.GROUP_BY:
+        sql = (
+            "SELECT {0} AS {0}, COUNT({1}) AS n, MIN({1}) AS min, AVG({1}) AS mean, MAX({1}) AS max"
+            " FROM assembly_metrics{2} GROUP BY {0} ORDER BY {0}"
+        ).format(args.GROUP_BY, args.METRIC, where)
+    else:
+        sql = "SELECT * FROM assembly_metrics{} ORDER BY run_date, sample".format(where)
+    return conn.execute(sql, params)
+
+
+def main(args=None):
+    args = parse_args(args)
+    conn = sqlite3.connect("file:{}?mode=ro".format(args.METRICS_DB), uri=True)
+    try:
+        cursor = conn.execute(args.SQL) if args.SQL else query_metrics(conn, args)
+        print("\t".join(x[0] for x in cursor.description))
+        for row in cursor:
+            print("\t".join("" if x is None else str(x) for x in row))
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -23,6 +23,12 @@ import argparse
 import csv
 import yaml
 
+# libyaml's emitter when PyYAML was built with it, the pure Python one otherwise
+try:
+    from yaml import CDumper as Dumper
+except ImportError:
+    from yaml import Dumper
+
 
 def parse_args(args=None):
     Description = "Create a yaml file from csv input file grouping samples as keys and resting fields as their value pair."
@@ -49,29 +55,97 @@ def parse_args(args=None):
         dest="OUT_PREFIX",
         help="Output file name",
     )
-    return parser.parse_args(args)
+
+    parser.add_argument(
+        "-s",
+        "--stream",
+        action="store_true",
+        dest="STREAM",
+        help="Write the samples one at a time, in input order, keeping memory flat for large tables.",
+    )
+
+    parser.add_argument(
+        "-d",
+        "--duplicates",
+        choices=["last", "first", "error"],
+        default=None,
+        dest="DUPLICATES",
+        help="What to do with repeated keys: keep the last row (default, not available with --stream), keep the first row (default with --stream), or fail.",
+    )
+    args = parser.parse_args(args)
+    if args.DUPLICATES is None:
+        args.DUPLICATES = "first" if args.STREAM else "last"
+    elif args.STREAM and args.DUPLICATES == "last":
+        parser.error(
+            "--stream keeps the first row of repeated keys, use --duplicates first or error"
+        )
+    return args
+
+
+def iter_csv(csv_file):
+    with open(csv_file, "r", newline="") as c:
+        yield from csv.DictReader(c)
+
+
+def duplicate_key(entry_key, duplicates):
+    if duplicates == "error":
+        sys.exit(f"ERROR: key '{entry_key}' is repeated in the input csv.")
+    print(
+        f"WARNING: key '{entry_key}' is repeated, keeping the {duplicates} row.",
+        file=sys.stderr,
+    )
 
 
-def parse_csv(csv_file):
-    with open(csv_file, "r") as c:
-        csv_reader = csv.DictReader(c)
-        data = [row for row in csv_reader]
-    return data
+def create_yaml(data, key, output_prefix, duplicates="last"):
+    yaml_data = {}
+    for entry in data:
+        if entry[key] in yaml_data:
+            duplicate_key(entry[key], duplicates)
+            if duplicates == "first":
+                continue
+        yaml_data[entry[key]] = {k: v for k, v in entry.items() if k != key}
+    with open(output_prefix + ".yaml", "w") as yaml_file:
+        yaml.dump(yaml_data, yaml_file, Dumper=Dumper, default_flow_style=False)
 
 
-def create_yaml(data, key, output_prefix):
-    yaml_data = {
-        entry[key]: {k: v for k, v in entry.items() if k != key} for entry in data
-    }
+def stream_yaml(data, key, output_prefix, duplicates="first"):
+    """
+    Writes the yaml one top-level key at a time, so only the keys already
+    written are kept in memory
+    """
+    seen = set()
     with open(output_prefix + ".yaml", "w") as yaml_file:
-        yaml.dump(yaml_data, yaml_file, default_flow_style=False)
+        for entry in data:
+            if entry[key] in seen:
+                duplicate_key(entry[key], duplicates)
+                continue
+            seen.add(entry[key])
+            yaml.dump(
+                {entry[key]: {k: v for k, v in entry.items() if k != key}},
+                yaml_file,
+                Dumper=Dumper,
+                default_flow_style=False,
+            )
+        if not seen:
+            yaml.dump({}, yaml_file, Dumper=Dumper, default_flow_style=False)
 
 
 def main(args=None):
     args = parse_args(args)
-    file_list = parse_csv(args.CSV_FILE)
-
-    create_yaml(data=file_list, key=args.KEY_FIELD, output_prefix=args.OUT_PREFIX)
+    if args.STREAM:
+        stream_yaml(
+            data=iter_csv(args.CSV_FILE),
+            key=args.KEY_FIELD,
+            output_prefix=args.OUT_PREFIX,
+            duplicates=args.DUPLICATES,
+        )
+    else:
+        create_yaml(
+            data=iter_csv(args.CSV_FILE),
+            key=args.KEY_FIELD,
+            output_prefix=args.OUT_PREFIX,
+            duplicates=args.DUPLICATES,
+        )
 
 
 if __name__ == "__main__":
@@ -25,12 +25,32 @@ OUTPUT:
     - *_fna.gz: file with the top-reference genome
     - *_gff.gz: file with the top-reference gff
     - *_protein.gz: file with the top-reference proteins
+    - *_genomic.fna, *_genomic.fna.fai: uncompressed top-reference genome
+      and its index (with -decompress)
+    - METRICS: per file transfer metrics, as MultiQC custom content (with -metrics)
 
 USAGE:
     python download_reference.py
     -file [FILE]
     -reference [REFERENCE]
     -out_dir [OUTDIR]
+    -index [INDEX] (optional)
+    -threads [THREADS] (optional)
+    -chunk_size [CHUNK_SIZE] (optional)
+    -retries [RETRIES] (optional)
+    -cache_dir [CACHE_DIR] (optional)
+    -mirror [MIRROR] (optional)
+    -decompress (optional)
+    -top_k [TOP_K] (optional)
+    -metrics [METRICS] (optional)
+
+    Batch mode, one ranking file per species group, outputs written next
+    to each ranking file:
+    python download_reference.py
+    -batch
+    -file [GROUP_1/FILE] [GROUP_2/FILE] ...
+    -reference [REFERENCE]
+    -allow_missing (optional)
 
 REQUIREMENTS:
     -Python >= 3.6
@@ -47,13 +67,24 @@ END_OF_HEADER
 
 import sys
 import argparse
+import fcntl
+import hashlib
+import json
 import os
+import shutil
+import sqlite3
+import tempfile
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from urllib.parse import urlsplit
 
 # import wget
 import requests
+from requests.adapters import HTTPAdapter
 
 
-# TODO: Generate report
 def parse_args(args=None):
     Description = "download the reference files \
         (fna, faa, gff)from the reference NCBI file."
@@ -65,96 +96,1024 @@ def parse_args(args=None):
 
     parser = argparse.ArgumentParser(description=Description, epilog=Epilog)
     parser.add_argument(
-        "-file", help="File containing the ranking of references from kmerfinder."
+        "-file",
+        nargs="+",
+        help="File containing the ranking of references from kmerfinder. Several files in batch mode.",
     )
     parser.add_argument(
         "-reference",
         help="File containing the paths to bacterial references. See example in: https://ftp.ncbi.nlm.nih.gov/genomes/ASSEMBLY_REPORTS/assembly_summary_refseq.txt",
     )
     parser.add_argument("-out_dir", help="Output directory.")
+    parser.add_argument(
+        "-batch",
+        action="store_true",
+        help="Resolve and download the top reference of every ranking file in one go, writing the outputs to the directory of each ranking file.",
+    )
+    parser.add_argument(
+        "-allow_missing",
+        action="store_true",
+        help="In batch mode, only fail when no group gets a reference. Groups without one are listed as failed in the metrics (default: fail when any group has none).",
+    )
+    parser.add_argument(
+        "-index",
+        default=None,
+        help="SQLite index of the NCBI reference file. Built on first use and rebuilt when the reference file changes (default: in -cache_dir if given, where it persists across runs, else next to the reference file).",
+    )
+    parser.add_argument(
+        "-threads",
+        type=int,
+        default=3,
+        help="Number of files downloaded concurrently (default: 3).",
+    )
+    parser.add_argument(
+        "-chunk_size",
+        type=int,
+        default=1024 * 1024,
+        help="Size in bytes of the chunks streamed to disk (default: 1048576).",
+    )
+    parser.add_argument(
+        "-connect_timeout",
+        type=float,
+        default=10,
+        help="Seconds to wait for the connection to the server (default: 10).",
+    )
+    parser.add_argument(
+        "-read_timeout",
+        type=float,
+        default=60,
+        help="Seconds to wait between bytes received from the server (default: 60).",
+    )
+    parser.add_argument(
+        "-retries",
+        type=int,
+        default=5,
+        help="Number of times an interrupted or corrupted download is resumed (default: 5).",
+    )
+    parser.add_argument(
+        "-backoff",
+        type=float,
+        default=1,
+        help="Seconds to wait before the first retry, doubled on every retry (default: 1).",
+    )
+    parser.add_argument(
+        "-cache_dir",
+        default=None,
+        help="Directory with reference files shared between runs. Looked up before downloading and filled afterwards (default: no cache).",
+    )
+    parser.add_argument(
+        "-cache_max_gb",
+        type=float,
+        default=50,
+        help="Size cap of the cache directory in GB, least recently used references are evicted past it (default: 50).",
+    )
+    parser.add_argument(
+        "-mirror",
+        default=None,
+        help="Local mirror (path or file:// url) of the NCBI genomes/ tree. Reference files are linked from it instead of downloaded (default: download).",
+    )
+    parser.add_argument(
+        "-mirror_root",
+        default="/genomes/",
+        help="Path of the NCBI urls that corresponds to the mirror directory (default: /genomes/).",
+    )
+    parser.add_argument(
+        "-decompress",
+        action="store_true",
+        help="Also write the uncompressed genome (*_genomic.fna) and its samtools-style index (*.fai), decompressed while downloading.",
+    )
+    parser.add_argument(
+        "-top_k",
+        type=int,
+        default=5,
+        help="Number of ranked references considered. The best ranked one whose files are all available is downloaded (default: 5).",
+    )
+    parser.add_argument(
+        "-metrics",
+        default=None,
+        help="Output file (*_mqc.json) with the transfer metrics of every reference file, as MultiQC custom content (default: not written).",
+    )
 
     return parser.parse_args(args)
 
 
-def download_references(file, reference, out_dir):
+def default_index_path(reference, cache_dir=None):
     """
-    Downloads the top reference from the NCBI database
+    Returns the index path in the reference cache directory, where it
+    persists across runs, or else next to the (resolved) reference file, or
+    in the working directory if that location is not writable
     """
+    real_reference = os.path.realpath(reference)
+    index_dir = cache_dir or os.path.dirname(real_reference)
+    if not os.access(index_dir, os.W_OK):
+        index_dir = os.getcwd()
+    return os.path.join(index_dir, os.path.basename(real_reference) + ".idx.sqlite")
 
-    reference_ends = ["_genomic.fna.gz", "_protein.faa.gz", "_genomic.gff.gz"]
 
-    # extract the most common reference from file
-    with open(file) as infile:
-        infile = infile.readlines()
-        infile = [
-            item.replace("\n", "").split("\t")
-            for item in infile
-            if not item.startswith("#")
-        ]
-        top_reference = infile[0][0]
+def index_is_current(index_path, reference, stat):
+    """
+    Checks whether the index was built from this reference file: same size
+    and modification time or, for a copy staged anew (a fresh work
+    directory), same size and md5
+    """
+    if not os.path.exists(index_path):
+        return False
+    try:
+        conn = sqlite3.connect(index_path)
+        try:
+            row = conn.execute(
+                "SELECT source_size, source_mtime_ns, source_md5 FROM meta LIMIT 1"
+            ).fetchone()
+            if row is None or row[0] != stat.st_size:
+                return False
+            if row[1] == stat.st_mtime_ns:
+                return True
+            if row[2] != file_md5(reference):
+                return False
+            with conn:
+                conn.execute("UPDATE meta SET source_mtime_ns = ?", (stat.st_mtime_ns,))
+            return True
+        finally:
+            conn.close()
+    except sqlite3.DatabaseError:
+        return False
+
+
+def build_reference_index(reference, index_path, stat):
+    """
+    Streams the NCBI reference file into a SQLite table mapping
+    <assembly_accession>_<asm_name> to its ftp_path
+    """
+
+    def rows(inref):
+        for line in inref:
+            if line.startswith("#"):
+                continue
+            row = line.rstrip("\n").split("\t")
+            if len(row) < 20:
+                continue
+            # assembly_accession + asm_name -> ftp_path
+            yield (f"{row[0]}_{row[15]}", row[19])
+
+    # build in a temporary file and move it in place, so concurrent tasks
+    # never see a half written index
+    fd, tmp_path = tempfile.mkstemp(
+        prefix=".tmp_", suffix=".sqlite", dir=os.path.dirname(index_path) or "."
+    )
+    os.close(fd)
+    try:
+        conn = sqlite3.connect(tmp_path)
+        conn.execute("PRAGMA journal_mode = OFF")
+        conn.execute("PRAGMA synchronous = OFF")
+        conn.execute(
+            "CREATE TABLE assemblies (ref_query TEXT PRIMARY KEY, ftp_path TEXT NOT NULL) WITHOUT ROWID"
+        )
+        conn.execute(
+            "CREATE TABLE meta (source_size INTEGER, source_mtime_ns INTEGER, source_md5 TEXT)"
+        )
+        with open(reference) as inref:
+            # keep the first occurrence, as the linear scan did
+            conn.executemany(
+                "INSERT OR IGNORE INTO assemblies VALUES (?, ?)", rows(inref)
+            )
+        conn.execute(
+            "INSERT INTO meta VALUES (?, ?, ?)",
+            (stat.st_size, stat.st_mtime_ns, file_md5(reference)),
+        )
+        conn.commit()
+        conn.close()
+        os.replace(tmp_path, index_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def open_reference_index(reference, index_path=None, cache_dir=None):
+    """
+    Returns a connection to the reference index, (re)building it
+    when missing or out of date
+    """
+    if index_path is None:
+        index_path = default_index_path(reference, cache_dir)
+
+    stat = os.stat(reference)
+    if not index_is_current(index_path, reference, stat):
+        print("Building reference index: ", index_path)
+        build_reference_index(reference, index_path, stat)
+
+    return sqlite3.connect(index_path)
+
+
+def lookup_assembly_url(index, ref_query):
+    """
+    Returns the assembly url (ftp_path + file prefix) of a reference, or None
+    """
+    row = index.execute(
+        "SELECT ftp_path FROM assemblies WHERE ref_query = ?", (ref_query,)
+    ).fetchone()
+    if row is None:
+        return None
+    return row[0] + "/" + ref_query
 
-    with open(str(top_reference) + ".winner", "w") as topref:
-        topref.write(top_reference)
 
-    # create the outdir (do nothing if already there)
+def make_session(pool_size):
+    """
+    Creates a keep-alive session whose connection pool fits all the workers
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+# ioctl request to share the extents of a file (reflink) on btrfs/xfs
+FICLONE = 0x40049409
+
+
+def link_or_copy(src, dst):
+    """
+    Hardlinks src to dst. Across filesystems, reflinks it where supported
+    and copies it otherwise.
+    """
+    if os.path.exists(dst):
+        os.remove(dst)
     try:
-        os.mkdir(out_dir)
-    except FileExistsError:
+        os.link(src, dst)
+        return
+    except OSError:
         pass
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            return
+        except OSError:
+            shutil.copyfileobj(fsrc, fdst, 1024 * 1024)
+    shutil.copystat(src, dst)
 
-    # open the reference and find the reference
-    with open(reference) as inref:
-        inref = inref.readlines()
-        inref = [
-            item.replace("\n", "").split("\t")
-            for item in inref
-            if not item.startswith("#")
-        ]
 
-        # Initialize an empty list to store the URLs
-        dir_url = []
-
-        # Iterate over each row in the inref
-        for row in inref:
-            # Construct the ref_query using assembly_accession and asm_name
-            assembly_accession = row[0]
-            asm_name = row[15]
-            ref_query = f"{assembly_accession}_{asm_name}"
-
-            # Check if ref_query matches the search value
-            if ref_query == top_reference:
-                # make url  # Append the 20th element of the row to the URL list:
-                assembly_url = row[19] + "/" + ref_query
-                dir_url.append(assembly_url)
-
-        if len(dir_url) == 0:
-            print(
-                "No assemblies responding to the top reference: ",
-                top_reference,
-                " were found",
-            )
-            sys.exit(1)
+def mirror_path(file_url, mirror, mirror_root="/genomes/"):
+    """
+    Rewrites an NCBI url to the matching file of the local mirror
+    """
+    if mirror.startswith("file://"):
+        mirror = urlsplit(mirror).path
+    url_path = urlsplit(file_url).path
+    if not url_path.startswith(mirror_root):
+        raise ValueError(f"{file_url} is not under {mirror_root}")
+    return os.path.join(mirror, url_path[len(mirror_root) :])
+
+
+def link_from_mirror(file_url, out_file, mirror, mirror_root="/genomes/"):
+    """
+    Links a reference file from the local mirror into out_file
+    """
+    local_file = mirror_path(file_url, mirror, mirror_root)
+    print(local_file)
+    link_or_copy(local_file, out_file)
+    return out_file
+
+
+@contextmanager
+def cache_lock(cache_dir, exclusive):
+    """
+    Holds a shared (readers) or exclusive (writers) lock on the cache
+    """
+    with open(os.path.join(cache_dir, ".lock"), "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def fetch_from_cache(cache_dir, ref_query, file_names, out_dir):
+    """
+    Links the cached reference files into out_dir. Returns False if the
+    reference is not (completely) cached.
+    """
+    entry = os.path.join(cache_dir, ref_query)
+    with cache_lock(cache_dir, exclusive=False):
+        if not all(os.path.exists(os.path.join(entry, f)) for f in file_names):
+            return False
+        for f in file_names:
+            link_or_copy(os.path.join(entry, f), os.path.join(out_dir, f))
+        # the entry mtime records its last use for the LRU eviction
+        os.utime(entry)
+    return True
+
+
+def add_to_cache(cache_dir, ref_query, file_names, out_dir, max_bytes):
+    """
+    Stores the downloaded reference files in the cache and evicts the least
+    recently used references until the cache fits in max_bytes
+    """
+    entry = os.path.join(cache_dir, ref_query)
+    with cache_lock(cache_dir, exclusive=True):
+        if not os.path.isdir(entry):
+            tmp_entry = tempfile.mkdtemp(prefix=".tmp_", dir=cache_dir)
+            for f in file_names:
+                link_or_copy(os.path.join(out_dir, f), os.path.join(tmp_entry, f))
+            os.rename(tmp_entry, entry)
+        os.utime(entry)
+        evict_from_cache(cache_dir, max_bytes, keep=ref_query)
+
+
+def evict_from_cache(cache_dir, max_bytes, keep):
+    """
+    Removes the least recently used entries until the cache fits in max_bytes.
+    Must be called holding the exclusive cache lock.
+    """
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if not entry.is_dir(follow_symlinks=False):
+            continue
+        if entry.name.startswith(".tmp_"):
+            # left behind by a killed task
+            shutil.rmtree(entry.path, ignore_errors=True)
+            continue
+        size = sum(f.stat().st_size for f in os.scandir(entry.path) if f.is_file())
+        entries.append((entry.stat().st_mtime, size, entry.name))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, name in sorted(entries):
+        if total <= max_bytes:
+            break
+        if name == keep:
+            continue
+        print("Evicting reference from cache: ", name)
+        shutil.rmtree(os.path.join(cache_dir, name), ignore_errors=True)
+        total -= size
+
+
+class FastaDecompressor:
+    """
+    Incrementally gunzips a FASTA file fed chunk by chunk, writing the
+    uncompressed FASTA and building its .fai index on the way
+    """
 
-        dir_url = str(dir_url[0])
+    def __init__(self, fasta_file):
+        self.fasta_file = fasta_file
+        self.out = open(fasta_file + ".part", "wb")
+        self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.pending = b""  # last, incomplete line
+        self.line_offset = 0  # offset of the next line in the FASTA
+        self.records = []  # [name, length, offset, linebases, linewidth]
 
-    # get url and reference file
+    def feed(self, data):
+        while data:
+            self.write(self.decompressor.decompress(data))
+            data = b""
+            # concatenated gzip members
+            if self.decompressor.eof and self.decompressor.unused_data:
+                data = self.decompressor.unused_data
+                self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def write(self, chunk):
+        self.out.write(chunk)
+        lines = (self.pending + chunk).split(b"\n")
+        self.pending = lines.pop()
+        for line in lines:
+            self.index_line(line, len(line) + 1)
+
+    def index_line(self, line, width):
+        if line.startswith(b">"):
+            name = line[1:].split(maxsplit=1)[0].decode() if line[1:].strip() else ""
+            self.records.append([name, 0, self.line_offset + width, 0, 0])
+        elif self.records:
+            record = self.records[-1]
+            bases = len(line.rstrip(b"\r"))
+            if record[3] == 0:
+                record[3], record[4] = bases, width
+            record[1] += bases
+        self.line_offset += width
+
+    def close(self):
+        """
+        Moves the FASTA in place and writes its index
+        """
+        self.write(self.decompressor.flush())
+        if self.pending:
+            self.index_line(self.pending, len(self.pending) + 1)
+            self.pending = b""
+        self.out.close()
+        os.replace(self.fasta_file + ".part", self.fasta_file)
+        with open(self.fasta_file + ".fai", "w") as fai:
+            for record in self.records:
+                fai.write("\t".join(map(str, record)) + "\n")
+
+    def abort(self):
+        self.out.close()
+        os.remove(self.fasta_file + ".part")
+
+
+def decompress_fasta(gz_file, fasta_file, chunk_size=1024 * 1024):
+    """
+    Decompresses and indexes a local gzipped FASTA
+    """
+    fasta = FastaDecompressor(fasta_file)
+    with open(gz_file, "rb") as fh:
+        for chunk in iter(lambda: fh.read(chunk_size), b""):
+            fasta.feed(chunk)
+    fasta.close()
+
+
+# Errors worth resuming the download for, rather than failing the task
+TRANSIENT_ERRORS = (
+    requests.exceptions.ConnectionError,
+    requests.exceptions.Timeout,
+    requests.exceptions.ChunkedEncodingError,
+)
+
+
+def is_transient(error):
+    """
+    Checks whether a failed request may succeed if retried
+    """
+    if isinstance(error, requests.exceptions.HTTPError):
+        return error.response is not None and (
+            error.response.status_code == 429 or error.response.status_code >= 500
+        )
+    return isinstance(error, TRANSIENT_ERRORS)
+
+
+def file_md5(path, chunk_size=1024 * 1024):
+    """
+    Returns the hex md5 digest of a file
+    """
+    md5 = hashlib.md5()
+    with open(path, "rb") as fh:
+        for chunk in iter(lambda: fh.read(chunk_size), b""):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def fetch_md5_checksums(session, dir_url, timeout):
+    """
+    Returns {file name: md5} from the md5checksums.txt of the assembly
+    directory, or an empty dict if it can not be fetched
+    """
+    checksums_url = dir_url.rsplit("/", 1)[0] + "/md5checksums.txt"
+    try:
+        response = session.get(checksums_url, timeout=timeout)
+        response.raise_for_status()
+    except requests.exceptions.RequestException as e:
+        print(f"WARNING: checksums will not be verified, {checksums_url}: {e}")
+        return {}
+
+    checksums = {}
+    for line in response.text.splitlines():
+        fields = line.split()
+        if len(fields) == 2:
+            checksums[os.path.basename(fields[1])] = fields[0]
+    return checksums
+
+
+def download_file(
+    session,
+    file_url,
+    out_file,
+    chunk_size,
+    timeout,
+    md5=None,
+    retries=5,
+    backoff=1,
+    decompress_to=None,
+):
+    """
+    Streams a single url to out_file. The data is written to a .part file
+    which is resumed with a Range request when the transfer breaks, checked
+    against md5 (if given) and then moved in place.
+
+    With decompress_to, an uninterrupted gzipped FASTA transfer is also
+    decompressed to that file as it arrives.
+
+    Returns the transfer metrics of the file.
+    """
+    print(file_url)
+    part_file = out_file + ".part"
+    attempt = 0
+    received = 0
+    ttfb = None
+    start = time.monotonic()
+    while True:
+        offset = os.path.getsize(part_file) if os.path.exists(part_file) else 0
+        headers = {"Range": f"bytes={offset}-"} if offset else {}
+        fasta = None
+        try:
+            request_start = time.monotonic()
+            with session.get(
+                file_url, stream=True, timeout=timeout, headers=headers
+            ) as response:
+                # the part file already holds the whole file
+                if not (offset and response.status_code == 416):
+                    response.raise_for_status()
+                    # servers ignoring the Range header send the whole file
+                    mode = "ab" if response.status_code == 206 else "wb"
+                    # resumed transfers are decompressed once complete
+                    if decompress_to is not None and mode == "wb":
+                        fasta = FastaDecompressor(decompress_to)
+                    with open(part_file, mode) as out:
+                        for chunk in response.iter_content(chunk_size=chunk_size):
+                            if ttfb is None:
+                                ttfb = time.monotonic() - request_start
+                            received += len(chunk)
+                            out.write(chunk)
+                            if fasta is not None:
+                                try:
+                                    fasta.feed(chunk)
+                                except zlib.error:
+                                    # left to the md5 check / decompress_fasta
+                                    fasta.abort()
+                                    fasta = None
+
+            if md5 is None or file_md5(part_file) == md5:
+                if fasta is not None:
+                    fasta.close()
+                break
+            # corrupted, start over
+            os.remove(part_file)
+            error = IOError(f"md5 mismatch for {file_url}")
+        except requests.exceptions.RequestException as e:
+            if not is_transient(e):
+                if fasta is not None:
+                    fasta.abort()
+                raise
+            error = e
+        if fasta is not None:
+            fasta.abort()
+
+        attempt += 1
+        if attempt > retries:
+            raise error
+        wait = backoff * 2 ** (attempt - 1)
+        print(f"Retrying {file_url} in {wait:.0f}s ({attempt}/{retries}): {error}")
+        time.sleep(wait)
+
+    os.replace(part_file, out_file)
+    return transfer_metrics(
+        out_file,
+        "download",
+        received,
+        time.monotonic() - start,
+        ttfb=ttfb,
+        retries=attempt,
+    )
+
+
+def transfer_metrics(out_file, source, transferred, duration, ttfb=None, retries=0):
+    """
+    Summarises how a reference file was obtained. Files linked from the
+    cache, the mirror or another species were not transferred: their bytes
+    are 0 and they have no throughput.
+    """
+    return {
+        "species": os.path.basename(os.path.dirname(os.path.abspath(out_file))),
+        "file": os.path.basename(out_file),
+        "source": source,
+        "bytes": transferred,
+        "ttfb_s": None if ttfb is None else round(ttfb, 3),
+        "duration_s": round(duration, 3),
+        "mb_per_s": (
+            round(transferred / 1e6 / duration, 2)
+            if transferred and duration > 0
+            else None
+        ),
+        "retries": retries,
+        "cache_hit": source == "cache",
+    }
+
+
+def write_metrics(metrics, metrics_file):
+    """
+    Writes the transfer metrics as a MultiQC custom content table
+    """
+    headers = {
+        "reference": {"title": "Reference", "description": "Downloaded reference"},
+        "source": {
+            "title": "Source",
+            "description": "download, cache, mirror, link (shared with another species) or failed (no reference found)",
+        },
+        "bytes": {
+            "title": "Bytes",
+            "description": "Bytes transferred over the network, including retries",
+            "format": "{:,.0f}",
+        },
+        "ttfb_s": {"title": "TTFB (s)", "description": "Time to first byte"},
+        "duration_s": {"title": "Duration (s)", "description": "Total duration"},
+        "mb_per_s": {"title": "MB/s", "description": "Average throughput"},
+        "retries": {"title": "Retries", "description": "Resumed transfers"},
+        "cache_hit": {"title": "Cache hit", "description": "Found in the cache"},
+    }
+    content = {
+        "id": "reference_download",
+        "section_name": "Reference genome download",
+        "description": "Transfer metrics of the reference genome files downloaded for the Kmerfinder best hits.",
+        "plot_type": "table",
+        "pconfig": {"id": "reference_download_table", "title": "Reference download"},
+        "headers": headers,
+        # species sharing a reference have one row each
+        "data": {
+            m["species"]
+            + "/"
+            + m["file"]: {k: m[k] for k in headers if m.get(k) is not None}
+            for m in metrics
+        },
+    }
+    with open(metrics_file, "w") as fh:
+        json.dump(content, fh, indent=4)
+
+
+def read_top_references(file, top_k=1):
+    """
+    Extracts the top_k most common references from a ranking file
+    """
+    top_references = []
+    with open(file) as infile:
+        for item in infile:
+            if len(top_references) == top_k:
+                break
+            if not item.startswith("#"):
+                top_references.append(item.replace("\n", "").split("\t")[0])
+    return top_references
+
+
+def probe_reference(session, dir_url, reference_ends, timeout):
+    """
+    Checks with HEAD requests that all the files of a reference are available
+    """
     for r_end in reference_ends:
-        out_file = out_dir + "/" + top_reference + r_end
-        file_url = dir_url + r_end
-        print(file_url)
+        try:
+            response = session.head(
+                dir_url + r_end, timeout=timeout, allow_redirects=True
+            )
+        except requests.exceptions.RequestException:
+            return False
+        if not response.ok:
+            return False
+    return True
+
+
+def select_references(candidate_urls, probe, threads):
+    """
+    Probes the candidates of every job concurrently and returns, per job, the
+    rank of the best ranked candidate with all files available (or None).
+    Probes ranked below a job's winner are cancelled once it is known. A
+    probe raising an error counts as the candidate not being available.
+    """
+    pool = ThreadPoolExecutor(threads)
+    futures = []
+    try:
+        for urls in candidate_urls:
+            futures.append([pool.submit(probe, url) for url in urls])
+        selected = []
+        for job_futures in futures:
+            winner = None
+            for rank, future in enumerate(job_futures):
+                try:
+                    available = future.result()
+                except Exception as e:
+                    print(f"WARNING: could not probe candidate {rank + 1}: {e}")
+                    available = False
+                if available:
+                    winner = rank
+                    break
+            for future in job_futures:
+                future.cancel()
+            selected.append(winner)
+    finally:
+        # shutdown(cancel_futures=True) needs Python >= 3.9
+        for job_futures in futures:
+            for future in job_futures:
+                future.cancel()
+        pool.shutdown(wait=False)
+    return selected
 
-        # wget.download(file_url, out_file)
-        response = requests.get(file_url, stream=True)
-        with open(out_file, "wb") as out:
-            for chunk in response.iter_content(chunk_size=8192):
-                out.write(chunk)
 
+def fetch_references(
+    jobs,
+    reference,
+    index_path=None,
+    threads=3,
+    chunk_size=1024 * 1024,
+    timeout=(10, 60),
+    retries=5,
+    backoff=1,
+    cache_dir=None,
+    cache_max_gb=50,
+    mirror=None,
+    mirror_root="/genomes/",
+    decompress=False,
+    metrics=None,
+):
+    """
+    Downloads the reference of every (candidates, out_dir) job, sharing the
+    reference index, the http session and the download pool. candidates are
+    the ranked references of the job; the best ranked one with all its files
+    available is downloaded, once for all the jobs choosing it. Returns the
+    downloaded reference of every job, None where none could be obtained.
+
+    The transfer metrics of every file are appended to metrics, if given.
+    """
+    if metrics is None:
+        metrics = []
+
+    reference_ends = ["_genomic.fna.gz", "_protein.faa.gz", "_genomic.gff.gz"]
+    threads = max(1, threads)
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def from_cache(ref_query, out_dir):
+        if cache_dir is None:
+            return False
+        file_names = [ref_query + r_end for r_end in reference_ends]
+        start = time.monotonic()
+        if not fetch_from_cache(cache_dir, ref_query, file_names, out_dir):
+            return False
+        print("Reference found in cache: ", ref_query)
+        duration = (time.monotonic() - start) / len(file_names)
+        for f in file_names:
+            out_file = os.path.join(out_dir, f)
+            metrics.append(
+                dict(
+                    transfer_metrics(out_file, "cache", 0, duration),
+                    reference=ref_query,
+                )
+            )
+        return True
+
+    winners = [None] * len(jobs)
+    unresolved = []
+    for i, (candidates, out_dir) in enumerate(jobs):
+        # create the outdir (do nothing if already there)
+        os.makedirs(out_dir, exist_ok=True)
+        # a cached top reference needs neither a lookup nor a probe
+        if candidates and from_cache(candidates[0], out_dir):
+            winners[i] = candidates[0]
+        else:
+            unresolved.append(i)
+
+    # find the candidates in the (indexed) NCBI reference file, in rank order
+    dir_urls = {}
+    if unresolved:
+        index = open_reference_index(reference, index_path, cache_dir)
+        try:
+            for i in unresolved:
+                for candidate in jobs[i][0]:
+                    dir_urls[candidate] = lookup_assembly_url(index, candidate)
+        finally:
+            index.close()
+    found = {i: [ref for ref in jobs[i][0] if dir_urls[ref]] for i in unresolved}
+
+    with make_session(threads) as session:
+        if mirror is not None:
+
+            def probe(dir_url):
+                return all(
+                    os.path.exists(mirror_path(dir_url + r_end, mirror, mirror_root))
+                    for r_end in reference_ends
+                )
+
+        else:
+
+            def probe(dir_url):
+                return probe_reference(session, dir_url, reference_ends, timeout)
+
+        # with a single candidate there is nothing to fall back to
+        to_probe = [i for i in unresolved if len(found[i]) > 1]
+        selected = select_references(
+            [[dir_urls[ref] for ref in found[i]] for i in to_probe], probe, threads
+        )
+        for i in unresolved:
+            if i in to_probe:
+                rank = selected[to_probe.index(i)]
+                winners[i] = None if rank is None else found[i][rank]
+            elif found[i]:
+                winners[i] = found[i][0]
+
+        for i in unresolved:
+            if winners[i] is None:
+                print(
+                    "No assemblies responding to the top reference: ",
+                    ", ".join(jobs[i][0]),
+                    " were found",
+                )
+
+        # species sharing a reference get it once, in the directory of the
+        # first of them, and linked into the others' afterwards
+        shared = {}
+        for i in unresolved:
+            if winners[i] is not None:
+                shared.setdefault(winners[i], []).append(jobs[i][1])
+        # top references were already looked up in the cache
+        cache_missed = {jobs[i][0][0] for i in unresolved if jobs[i][0]}
+        pending = [
+            (top_reference, out_dirs[0])
+            for top_reference, out_dirs in shared.items()
+            if top_reference in cache_missed
+            or not from_cache(top_reference, out_dirs[0])
+        ]
+
+        failed = {}
+        if mirror is not None:
+            for top_reference, out_dir in pending:
+                try:
+                    for r_end in reference_ends:
+                        out_file = os.path.join(out_dir, top_reference + r_end)
+                        start = time.monotonic()
+                        link_from_mirror(
+                            dir_urls[top_reference] + r_end,
+                            out_file,
+                            mirror,
+                            mirror_root,
+                        )
+                        metrics.append(
+                            dict(
+                                transfer_metrics(
+                                    out_file, "mirror", 0, time.monotonic() - start
+                                ),
+                                reference=top_reference,
+                            )
+                        )
+                except (OSError, ValueError) as e:
+                    failed[top_reference] = e
+        elif pending:
+            # get url and reference files, all at once over the shared session
+            with ThreadPoolExecutor(threads) as pool:
+                checksums = dict(
+                    zip(
+                        [top_reference for top_reference, _ in pending],
+                        pool.map(
+                            lambda job: fetch_md5_checksums(
+                                session, dir_urls[job[0]], timeout
+                            ),
+                            pending,
+                        ),
+                    )
+                )
+                futures = [
+                    (
+                        top_reference,
+                        pool.submit(
+                            download_file,
+                            session,
+                            dir_urls[top_reference] + r_end,
+                            os.path.join(out_dir, top_reference + r_end),
+                            chunk_size,
+                            timeout,
+                            md5=checksums[top_reference].get(top_reference + r_end),
+                            retries=retries,
+                            backoff=backoff,
+                            decompress_to=(
+                                os.path.join(out_dir, top_reference + "_genomic.fna")
+                                if decompress and r_end == "_genomic.fna.gz"
+                                else None
+                            ),
+                        ),
+                    )
+                    for top_reference, out_dir in pending
+                    for r_end in reference_ends
+                ]
+                for top_reference, future in futures:
+                    try:
+                        metrics.append(dict(future.result(), reference=top_reference))
+                    except (requests.exceptions.RequestException, OSError) as e:
+                        failed.setdefault(top_reference, e)
+
+            if cache_dir is not None:
+                for top_reference, out_dir in pending:
+                    if top_reference in failed:
+                        continue
+                    add_to_cache(
+                        cache_dir,
+                        top_reference,
+                        [top_reference + r_end for r_end in reference_ends],
+                        out_dir,
+                        cache_max_gb * 1024**3,
+                    )
+
+    # a failed reference fails the species that chose it, not the others
+    for top_reference, error in failed.items():
+        print("Failed to get reference ", top_reference, ": ", error)
+        out_dir = shared.pop(top_reference)[0]
+        for f in os.listdir(out_dir):
+            if f.startswith(top_reference):
+                os.remove(os.path.join(out_dir, f))
+    winners = [None if w in failed else w for w in winners]
+
+    linked_dirs = {out_dir for out_dirs in shared.values() for out_dir in out_dirs[1:]}
+
+    # genomes not decompressed on the fly (cached, linked or resumed)
+    if decompress:
+        for top_reference, (_, out_dir) in zip(winners, jobs):
+            if top_reference is None or out_dir in linked_dirs:
+                continue
+            fasta_file = os.path.join(out_dir, top_reference + "_genomic.fna")
+            if not os.path.exists(fasta_file):
+                decompress_fasta(fasta_file + ".gz", fasta_file, chunk_size)
+
+    file_ends = reference_ends
+    if decompress:
+        file_ends = reference_ends + ["_genomic.fna", "_genomic.fna.fai"]
+    for top_reference, out_dirs in shared.items():
+        for out_dir in out_dirs[1:]:
+            for r_end in file_ends:
+                out_file = os.path.join(out_dir, top_reference + r_end)
+                start = time.monotonic()
+                link_or_copy(os.path.join(out_dirs[0], top_reference + r_end), out_file)
+                if r_end in reference_ends:
+                    metrics.append(
+                        dict(
+                            transfer_metrics(
+                                out_file, "link", 0, time.monotonic() - start
+                            ),
+                            reference=top_reference,
+                        )
+                    )
+
+    return winners
+
+
+def download_references(file, reference, out_dir, top_k=5, metrics_file=None, **kwargs):
+    """
+    Downloads the top reference from the NCBI database
+    """
+    candidates = read_top_references(file, top_k)
+    metrics = []
+    top_reference = fetch_references(
+        [(candidates, out_dir)], reference, metrics=metrics, **kwargs
+    )[0]
+    if top_reference is None:
+        sys.exit(1)
+
+    with open(str(top_reference) + ".winner", "w") as topref:
+        topref.write(top_reference)
+
+    if metrics_file is not None:
+        write_metrics(metrics, metrics_file)
+    return
+
+
+def download_references_batch(
+    files, reference, top_k=5, metrics_file=None, allow_missing=False, **kwargs
+):
+    """
+    Downloads the top reference of every species group, writing the winner
+    and reference files next to each group's ranking file. Exits with an
+    error when a group gets no reference, unless allow_missing, in which case
+    it is listed as failed in the metrics and only all groups failing is an
+    error.
+    """
+    jobs = [
+        (read_top_references(file, top_k), os.path.dirname(file) or ".")
+        for file in files
+    ]
+    metrics = []
+    winners = fetch_references(jobs, reference, metrics=metrics, **kwargs)
+
+    failed = []
+    for top_reference, (_, group_dir) in zip(winners, jobs):
+        if top_reference is None:
+            print("No reference downloaded for: ", group_dir)
+            failed.append(group_dir)
+            metrics.append(
+                transfer_metrics(os.path.join(group_dir, "-"), "failed", 0, 0)
+            )
+            continue
+        with open(os.path.join(group_dir, str(top_reference) + ".winner"), "w") as f:
+            f.write(top_reference)
+
+    if metrics_file is not None:
+        write_metrics(metrics, metrics_file)
+    if failed and (not allow_missing or len(failed) == len(jobs)):
+        sys.exit(1)
     return
 
 
 def main(args=None):
     args = parse_args(args)
-    download_references(args.file, args.reference, args.out_dir)
+    settings = dict(
+        index_path=args.index,
+        threads=args.threads,
+        chunk_size=args.chunk_size,
+        timeout=(args.connect_timeout, args.read_timeout),
+        retries=args.retries,
+        backoff=args.backoff,
+        cache_dir=args.cache_dir,
+        cache_max_gb=args.cache_max_gb,
+        mirror=args.mirror,
+        mirror_root=args.mirror_root,
+        decompress=args.decompress,
+        top_k=args.top_k,
+        metrics_file=args.metrics,
+    )
+    if args.batch:
+        download_references_batch(
+            args.file, args.reference, allow_missing=args.allow_missing, **settings
+        )
+    else:
+        download_references(args.file[0], args.reference, args.out_dir, **settings)
 
 
 if __name__ == "__main__":
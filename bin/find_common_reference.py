@@ -16,12 +16,20 @@ DESCRIPTION:
 INPUT:
     -DIRECTORY: directory containing all kmerfinder results.
     -OUTFILE: Name of the file to write the whole results in.
+    -GROUPS: (batch mode) tab separated file assigning each report in
+        DIRECTORY to a group, one "group<TAB>report file name" per line.
+    -STATE: (optional) SQLite file keeping the best hit of every report
+        seen in previous runs. Reports are identified by their content,
+        so re-submitted reports are only counted once.
 
 OUTPUT:
     -OUTFILE: file containing the kmerfinder results.
+        In batch mode, one GROUP/OUTFILE per group.
 
 USAGE:
     python find_common_reference.py -d [DIRECTORY] -o [OUTFILE]
+    python find_common_reference.py -d [DIRECTORY] -o [OUTFILE] -batch [GROUPS]
+    python find_common_reference.py -d [DIRECTORY] -o [OUTFILE] -state [STATE]
 REQUIREMENTS:
     -Python >= 3.6
 
@@ -37,6 +45,14 @@ import os
 import sys
 import errno
 import argparse
+import hashlib
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+# Below this many reports, reading them one after the other is faster
+# than starting a thread pool
+PARALLEL_MIN_REPORTS = 64
 
 
 def parse_args(args=None):
@@ -49,40 +65,177 @@ def parse_args(args=None):
     parser = argparse.ArgumentParser(description=Description, epilog=Epilog)
     parser.add_argument("-d", help="Input directory.")
     parser.add_argument("-o", help="Output file.")
+    parser.add_argument(
+        "-batch",
+        default=None,
+        help="Groups file (group<TAB>report file name). Writes one ranking per group to <group>/<output file>.",
+    )
+    parser.add_argument(
+        "-threads",
+        type=int,
+        default=8,
+        help="Number of reports read concurrently (default: 8).",
+    )
+    parser.add_argument(
+        "-state",
+        default=None,
+        help="SQLite file accumulating the best hits across runs. Only reports not seen before are parsed and the ranking covers all of them (default: no state).",
+    )
     return parser.parse_args(args)
 
 
-def group_references(kmer_result_dir, out_file):
+def read_best_hit(k_file):
     """
-    Unifies the kmerfinder results, and counts their occurrences
+    Reads only the heading and the best hit (first two lines) of a
+    kmerfinder result file. Returns None if there is no hit.
+    """
+    with open(k_file, "r") as fh:
+        heading = fh.readline()
+        first_line = fh.readline()
+    if not first_line:
+        return None
+    return heading, first_line
+
+
+@lru_cache(maxsize=None)
+def heading_indexes(heading):
+    """
+    Finds the assembly and description columns, once per heading layout
+    """
+    heading = heading.split("\t")
+    return heading.index("# Assembly"), heading.index("Description")
+
+
+def tally_references(report_files, threads=8):
+    """
+    Counts the occurrences of the best hit reference among kmerfinder results
     """
     reference_assembly = {}
 
-    # for file in dir
-    for k_file in os.listdir(kmer_result_dir):
-        # open file
-        with open(os.path.join(kmer_result_dir, k_file), "r") as fh:
-            file_lines = fh.readlines()
+    # read the best hit of every file, in order
+    if threads > 1 and len(report_files) >= PARALLEL_MIN_REPORTS:
+        with ThreadPoolExecutor(threads) as pool:
+            best_hits = list(pool.map(read_best_hit, report_files))
+    else:
+        best_hits = [read_best_hit(k_file) for k_file in report_files]
 
-        # remove heading
-        try:
-            heading = file_lines[0].split("\t")
-            first_line = file_lines[1].split("\t")
+    for best_hit in best_hits:
+        if best_hit is None:
+            continue
+        heading, first_line = best_hit
+        first_line = first_line.split("\t")
 
-            # where is the assembly in the header?
-            # find reference according to index
-            index_assembly = heading.index("# Assembly")
+        # where is the assembly in the header?
+        # find reference according to index
+        index_assembly, index_description = heading_indexes(heading)
+        try:
             reference = first_line[index_assembly]
 
             # add it to the dict if not there
             if reference not in reference_assembly:
-                index_description = heading.index("Description")
                 reference_assembly[reference] = [0, first_line[index_description]]
             # sum 1 for another occurrence
             reference_assembly[reference][0] += 1
         except IndexError:
             pass
 
+    return reference_assembly
+
+
+def read_report(k_file):
+    """
+    Returns the content hash of a kmerfinder result file and its best hit
+    """
+    with open(k_file, "rb") as fh:
+        content = fh.read()
+    lines = content.decode().split("\n", 2)
+    best_hit = None
+    if len(lines) > 1 and lines[1]:
+        best_hit = (lines[0] + "\n", lines[1] + "\n")
+    return hashlib.sha256(content).hexdigest(), best_hit
+
+
+def open_state(state_file):
+    """
+    Opens the state database, creating it if needed
+    """
+    conn = sqlite3.connect(state_file, timeout=60)
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS reports (
+            grp TEXT NOT NULL,
+            content_hash TEXT NOT NULL,
+            reference TEXT,
+            description TEXT,
+            PRIMARY KEY (grp, content_hash)
+        )
+        """
+    )
+    return conn
+
+
+def tally_references_state(report_files, state_file, group="", threads=8):
+    """
+    Records the best hit of the reports not yet in the state file and counts
+    the occurrences of every reference among all the recorded reports
+    """
+    if threads > 1 and len(report_files) >= PARALLEL_MIN_REPORTS:
+        with ThreadPoolExecutor(threads) as pool:
+            reports = list(pool.map(read_report, report_files))
+    else:
+        reports = [read_report(k_file) for k_file in report_files]
+
+    conn = open_state(state_file)
+    try:
+        with conn:
+            known = {
+                row[0]
+                for row in conn.execute(
+                    "SELECT content_hash FROM reports WHERE grp = ?", (group,)
+                )
+            }
+            for content_hash, best_hit in reports:
+                if content_hash in known:
+                    continue
+                known.add(content_hash)
+                reference = description = None
+                if best_hit is not None:
+                    heading, first_line = best_hit
+                    first_line = first_line.split("\t")
+                    index_assembly, index_description = heading_indexes(heading)
+                    try:
+                        reference = first_line[index_assembly]
+                        description = first_line[index_description]
+                    except IndexError:
+                        reference = description = None
+                conn.execute(
+                    "INSERT OR IGNORE INTO reports VALUES (?, ?, ?, ?)",
+                    (group, content_hash, reference, description),
+                )
+
+        # the description of a reference is the one of its first report
+        reference_assembly = {}
+        for reference, count, description, _ in conn.execute(
+            """
+            SELECT reference, COUNT(*), description, MIN(rowid)
+            FROM reports
+            WHERE grp = ? AND reference IS NOT NULL
+            GROUP BY reference
+            ORDER BY MIN(rowid)
+            """,
+            (group,),
+        ):
+            reference_assembly[reference] = [count, description]
+    finally:
+        conn.close()
+
+    return reference_assembly
+
+
+def write_references(reference_assembly, out_file):
+    """
+    Writes the references, more occurrences first
+    """
     # sort it (more occurrences first in file)
     order_reference = dict(
         sorted(reference_assembly.items(), key=lambda x: x[1][0], reverse=True)
@@ -95,9 +248,57 @@ def group_references(kmer_result_dir, out_file):
     return
 
 
+def tally(report_files, threads=8, state_file=None, group=""):
+    """
+    Counts the references of the given reports, or of every report recorded
+    in the state file when there is one
+    """
+    if state_file is None:
+        return tally_references(report_files, threads)
+    return tally_references_state(report_files, state_file, group, threads)
+
+
+def group_references(kmer_result_dir, out_file, threads=8, state_file=None):
+    """
+    Unifies the kmerfinder results, and counts their occurrences
+    """
+    report_files = [
+        os.path.join(kmer_result_dir, k_file) for k_file in os.listdir(kmer_result_dir)
+    ]
+    write_references(tally(report_files, threads, state_file), out_file)
+    return
+
+
+def group_references_batch(
+    kmer_result_dir, out_file, groups_file, threads=8, state_file=None
+):
+    """
+    Ranks the references of every group of kmerfinder results in one go,
+    writing <group>/<out_file> for each group
+    """
+    groups = {}
+    with open(groups_file) as fh:
+        for line in fh:
+            if not line.strip():
+                continue
+            group, k_file = line.rstrip("\n").split("\t")
+            groups.setdefault(group, []).append(os.path.join(kmer_result_dir, k_file))
+
+    for group, report_files in groups.items():
+        os.makedirs(group, exist_ok=True)
+        write_references(
+            tally(report_files, threads, state_file, group),
+            os.path.join(group, out_file),
+        )
+    return
+
+
 def main(args=None):
     args = parse_args(args)
-    group_references(args.d, args.o)
+    if args.batch:
+        group_references_batch(args.d, args.o, args.batch, args.threads, args.state)
+    else:
+        group_references(args.d, args.o, args.threads, args.state)
 
 
 if __name__ == "__main__":
@@ -24,6 +24,29 @@ import re
 import csv
 import pickle
 import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import yaml
+
+# Prefix of the result fields in the summaries
+STEP = "07-kmerfinder_"
+
+# Below this many samples, parsing them in this process is faster than
+# starting a process pool
+PARALLEL_MIN_SAMPLES = 200
+
+# Columns of the columnar store: (column name, dtype, result field). Text
+# columns are fixed width unicode so that every column can be memory-mapped
+HIT_COLUMNS = [
+    ("assembly", "U", "# Assembly"),
+    ("species", "U", "Species"),
+    ("score", "f8", "Score"),
+    ("query_coverage", "f8", "Query_Coverage"),
+    ("template_coverage", "f8", "Template_Coverage"),
+    ("depth", "f8", "Depth"),
+]
 
 
 #################
@@ -66,6 +89,28 @@ def check_arg(args=None):
         "--output_csv", "-c", required=True, help="The output in csv file"
     )
 
+    parser.add_argument(
+        "--output_yaml",
+        "-y",
+        default=None,
+        help="The output in yaml file (MultiQC input, samples as keys)",
+    )
+
+    parser.add_argument(
+        "--output_columns",
+        "-n",
+        default=None,
+        help="Columnar store directory (one .npy file per column, memory-mappable). New runs are appended to it",
+    )
+
+    parser.add_argument(
+        "--threads",
+        "-t",
+        type=int,
+        default=1,
+        help="Number of processes parsing the results files",
+    )
+
     # Example: python3 parse_kmerfinder.py -p /home/s.gonzalez/07-kmerfinder -b p_dic.dicke -c p_kmer.csv
 
     return parser.parse_args()
@@ -76,22 +121,39 @@ def check_arg(args=None):
 #################
 
 
-def kmerfinder_dictionary(file_txt):
+def read_kmerfinder_result(file_txt):
+    """
+    Description:
+        Function to read a result.txt file once, decoding only the header
+        and the two best hits
+    Input:
+        result.txt file
+    Return:
+        number of lines, list of the first three lines
+    """
+
+    with open(file_txt, "rb") as lookupfile:
+        content = lookupfile.read()
+    num_lines = content.count(b"\n")
+    if content and not content.endswith(b"\n"):
+        num_lines += 1
+    lines = [line.decode() for line in content.split(b"\n", 3)[:3]]
+    return num_lines, lines
+
+
+def kmerfinder_dictionary(file_txt, result=None):
     """
     Description:
         Function to extract the relevant part of result.txt file
     Input:
         result.txt file
+        result # read_kmerfinder_result() of the file, if already read
     Return:
         dictionary
     """
 
-    step = "07-kmerfinder_"  # FIXME
-
-    num_lines = sum(1 for line in open(file_txt))
+    num_lines, lines = result or read_kmerfinder_result(file_txt)
     hits = num_lines - 1  # to count the total number of hits
-    lookupfile = open(file_txt, "r")
-    lines = lookupfile.readlines()
     parameters = lines[0].strip().split("\t")
     if num_lines > 1:
         values_best_hit = lines[1].strip().split("\t")
@@ -102,19 +164,19 @@ def kmerfinder_dictionary(file_txt):
 
     for i in range(len(parameters)):
         if num_lines > 1:
-            kmer_dict[step + "best_hit_" + parameters[i]] = values_best_hit[i]
+            kmer_dict[STEP + "best_hit_" + parameters[i]] = values_best_hit[i]
         else:
-            kmer_dict[step + "best_hit_" + parameters[i]] = ""
+            kmer_dict[STEP + "best_hit_" + parameters[i]] = ""
 
         kmer_dict.update(Total_hits_07_kmerfinder=hits)
 
         if num_lines > 2:
 
-            kmer_dict[step + "second_hit_" + parameters[i]] = values_second_hit[i]
+            kmer_dict[STEP + "second_hit_" + parameters[i]] = values_second_hit[i]
 
         else:
 
-            kmer_dict[step + "second_hit_" + parameters[i]] = ""
+            kmer_dict[STEP + "second_hit_" + parameters[i]] = ""
 
     return kmer_dict
 
@@ -168,6 +230,114 @@ def dictionary2csv(dictionary, csv_file):
     return
 
 
+def dictionary2yaml(dictionary, yaml_file):
+    """
+
+    Description:
+        Function to create a yaml from a dictionary, with the same content
+        the csv file would give: every sample has all the fields of the
+        csv header, as strings
+    Input:
+        dictionary
+    Return:
+        yaml file
+    """
+
+    header = sorted(set(i for b in map(dict.keys, dictionary.values()) for i in b))
+    yaml_data = {
+        a: {i: str(b.get(i, "")) for i in header} for a, b in dictionary.items()
+    }
+    with open(yaml_file, "w") as f:
+        yaml.dump(yaml_data, f, default_flow_style=False)
+    return
+
+
+def to_float(value):
+    """
+    Description:
+        Function to convert a result field to float, NaN when missing
+    Input:
+        value
+    Return:
+        float
+    """
+
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return float("nan")
+
+
+def dictionary2columns(dictionary, store_dir):
+    """
+
+    Description:
+        Function to append a dictionary to a columnar store. Every run adds
+        a part-<n> directory with one .npy file per column; the parts are
+        never rewritten, so readers can memory-map them while new runs are
+        appended
+    Input:
+        dictionary
+        store_dir # columnar store directory, created if needed
+    Return:
+        part directory
+    """
+
+    samples = list(dictionary)
+    columns = {
+        "sample_name": np.array(samples, dtype="U"),
+        "total_hits": np.array(
+            [dictionary[a].get("Total_hits_07_kmerfinder", 0) for a in samples],
+            dtype="i8",
+        ),
+    }
+    for hit in ("best_hit", "second_hit"):
+        for name, dtype, field in HIT_COLUMNS:
+            values = [dictionary[a].get(STEP + hit + "_" + field, "") for a in samples]
+            if dtype == "f8":
+                values = [to_float(v) for v in values]
+            columns[hit + "_" + name] = np.array(values, dtype=dtype)
+
+    # write the part aside and publish it with a rename, so that concurrent
+    # readers and writers never see a half written part
+    os.makedirs(store_dir, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(prefix=".tmp-", dir=store_dir)
+    for name, values in columns.items():
+        np.save(os.path.join(tmp_dir, name + ".npy"), values)
+
+    part = len([d for d in os.listdir(store_dir) if d.startswith("part-")])
+    while True:
+        part_dir = os.path.join(store_dir, "part-%05d" % part)
+        try:
+            os.rename(tmp_dir, part_dir)
+            return part_dir
+        except OSError:
+            if not os.path.exists(part_dir):
+                raise
+            part += 1
+
+
+def read_columns(store_dir, columns):
+    """
+
+    Description:
+        Function to read some columns of a columnar store, memory-mapped
+    Input:
+        store_dir
+        columns # names of the columns to read
+    Return:
+        list of dictionaries (column name: array), one per part
+    """
+
+    return [
+        {
+            name: np.load(os.path.join(store_dir, part, name + ".npy"), mmap_mode="r")
+            for name in columns
+        }
+        for part in sorted(d for d in os.listdir(store_dir) if d.startswith("part-"))
+    ]
+
+
 ###################
 ### MAIN SCRIPT ###
 ###################
@@ -197,9 +367,21 @@ if __name__ == "__main__":
     # Create a dictionary
     kmer_all = {}
 
-    for sample in sample_list:
-        file_name = os.path.join(path, sample + "_results.txt")
-        kmer_all[sample] = kmerfinder_dictionary(file_name)
+    file_names = [os.path.join(path, sample + "_results.txt") for sample in sample_list]
+    if arguments.threads > 1 and len(file_names) >= PARALLEL_MIN_SAMPLES:
+        # files are read in the pool, the dictionaries built here, as in
+        # the serial path, so that the pickle is byte-identical to it
+        with ProcessPoolExecutor(arguments.threads) as pool:
+            results = pool.map(
+                read_kmerfinder_result,
+                file_names,
+                chunksize=max(1, len(file_names) // (arguments.threads * 4)),
+            )
+            for sample, file_name, result in zip(sample_list, file_names, results):
+                kmer_all[sample] = kmerfinder_dictionary(file_name, result)
+    else:
+        for sample, file_name in zip(sample_list, file_names):
+            kmer_all[sample] = kmerfinder_dictionary(file_name)
 
     print("kmerfinder_dictionary done")
     # print (kmer_all)
@@ -215,3 +397,17 @@ if __name__ == "__main__":
     dictionary2csv(kmer_all, arguments.output_csv)
 
     print("kmerfinder_dictionary_csv done")
+
+    # Convert the dictionary to yaml file
+
+    if arguments.output_yaml:
+        dictionary2yaml(kmer_all, arguments.output_yaml)
+
+        print("kmerfinder_dictionary_yaml done")
+
+    # Append the dictionary to the columnar store
+
+    if arguments.output_columns:
+        dictionary2columns(kmer_all, arguments.output_columns)
+
+        print("kmerfinder_dictionary_columns done")
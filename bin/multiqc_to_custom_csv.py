@@ -5,7 +5,30 @@ import os
 import sys
 import errno
 import argparse
+import glob
+import json
+import threading
+from datetime import date
 import yaml
+from assembly_metrics_db import upsert_metrics
+from concurrent.futures import Future, ThreadPoolExecutor
+
+# Fastest parsers available: orjson and the libyaml loader are optional
+try:
+    import orjson
+
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
+## Data files parsed in this invocation, shared by every caller
+PARSED_FILES = {}
+PARSED_FILES_LOCK = threading.Lock()
 
 
 def parse_args(args=None):
@@ -36,6 +59,38 @@ def parse_args(args=None):
         default="summary",
         help="Full path to output prefix (default: 'summary').",
     )
+    parser.add_argument(
+        "-rd",
+        "--raw_data_dir",
+        type=str,
+        dest="RAW_DATA_DIR",
+        default=None,
+        help="Directory with the tool outputs (fastp/*.json, nanoplot/*.txt, quast/*/report.tsv, extra/multiqc_kmerfinder.yaml). When given, the metrics are computed from them instead of from the MultiQC data directory, so MultiQC does not need to run first.",
+    )
+    parser.add_argument(
+        "-db",
+        "--metrics_db",
+        type=str,
+        dest="METRICS_DB",
+        default=None,
+        help="SQLite file where the per-sample metrics of this run are upserted, to be queried across runs with assembly_metrics_db.py (default: none).",
+    )
+    parser.add_argument(
+        "-run_id",
+        "--run_id",
+        type=str,
+        dest="RUN_ID",
+        default=None,
+        help="Run identifier of the rows upserted in --metrics_db (default: the run date).",
+    )
+    parser.add_argument(
+        "-run_date",
+        "--run_date",
+        type=str,
+        dest="RUN_DATE",
+        default=None,
+        help="Run date (YYYY-MM-DD) of the rows upserted in --metrics_db (default: today).",
+    )
     return parser.parse_args(args)
 
 
@@ -48,60 +103,218 @@ def make_dir(path):
                 raise
 
 
-# Find key in dictionary created from YAML file recursively
-# From https://stackoverflow.com/a/37626981
-def find_tag(d, tag):
-    if tag in d:
-        yield d[tag]
-    for k, v in d.items():
-        if isinstance(v, dict):
-            for i in find_tag(v, tag):
-                yield i
+# Parse a file once per invocation, concurrent callers wait for the first one
+def parse_once(path, parse):
+    with PARSED_FILES_LOCK:
+        future = PARSED_FILES.get(path)
+        owner = future is None
+        if owner:
+            future = PARSED_FILES[path] = Future()
+    if owner:
+        try:
+            future.set_result(parse(path))
+        except Exception as exception:
+            future.set_exception(exception)
+    return future.result()
+
+
+def parse_json(path):
+    with open(path, "rb") as f:
+        return json_loads(f.read())
+
+
+def parse_yaml(path):
+    with open(path, "rb") as f:
+        return yaml.load(f, Loader=SafeLoader)
+
+
+# Load the data of a MultiQC YAML file, preferring the JSON copies: the
+# per-module JSON file, then the raw data saved in multiqc_data.json.
+# Returns None when the data is nowhere to be found
+def load_data_file(yaml_file):
+    data_dir = os.path.dirname(yaml_file)
+    module = os.path.splitext(os.path.basename(yaml_file))[0]
+    json_file = os.path.join(data_dir, module + ".json")
+    if os.path.exists(json_file):
+        return parse_once(json_file, parse_json)
+    data_json = os.path.join(data_dir, "multiqc_data.json")
+    if os.path.exists(data_json):
+        saved_raw_data = parse_once(data_json, parse_json).get(
+            "report_saved_raw_data", {}
+        )
+        if module in saved_raw_data:
+            return saved_raw_data[module]
+    if os.path.exists(yaml_file):
+        return parse_once(yaml_file, parse_yaml)
+    return None
+
+
+## Suffixes the pipeline adds to sample names in tool output file names
+## and QUAST assembly labels, the name is truncated at the first one found
+SAMPLE_NAME_SUFFIXES = [
+    ".fastp",
+    ".json",
+    ".txt",
+    ".scaffolds",
+    ".contigs",
+    ".consensus",
+    "_polished_genome",
+]
+
+
+def clean_sample_name(name):
+    for suffix in SAMPLE_NAME_SUFFIXES:
+        if suffix in name:
+            name = name.split(suffix)[0]
+    return name
+
+
+# Numbers as MultiQC stores them, everything else as text
+def to_number(value):
+    try:
+        return float(value.replace(",", ""))
+    except ValueError:
+        return value
+
+
+def parse_fastp_jsons(raw_data_dir):
+    return {
+        clean_sample_name(os.path.basename(json_file)): parse_json(json_file)
+        for json_file in sorted(
+            glob.glob(os.path.join(raw_data_dir, "fastp", "*.json"))
+        )
+    }
+
+
+# NanoStats text reports, in the legacy "Key: value" layout or the
+# "key<TAB>value" one. Keys are suffixed with "_fastq" like MultiQC does for
+# reports of fastq files
+def parse_nanostat_txts(raw_data_dir):
+    nanostat_keys = {"median_qual": "Median read quality"}
+    data = {}
+    for txt_file in sorted(glob.glob(os.path.join(raw_data_dir, "nanoplot", "*.txt"))):
+        stats = {}
+        with open(txt_file) as f:
+            for line in f:
+                if ":" in line:
+                    key, value = line.split(":", 1)
+                elif "\t" in line:
+                    key, value = line.split("\t", 1)
+                    key = nanostat_keys.get(key, key.replace("_", " ").capitalize())
+                else:
+                    continue
+                stats.setdefault(key.strip() + "_fastq", to_number(value.strip()))
+        data[clean_sample_name(os.path.basename(txt_file))] = stats
+    return data
+
+
+# QUAST report.tsv files, one column per assembly
+def parse_quast_reports(raw_data_dir):
+    data = {}
+    for tsv_file in sorted(
+        glob.glob(os.path.join(raw_data_dir, "quast", "*", "report.tsv"))
+    ):
+        with open(tsv_file) as f:
+            s_names = [
+                clean_sample_name(x) for x in f.readline().rstrip("\n").split("\t")[1:]
+            ]
+            for s_name in s_names:
+                data.setdefault(s_name, {})
+            for line in f:
+                values = line.rstrip("\n").split("\t")
+                for s_name, value in zip(s_names, values[1:]):
+                    data[s_name][values[0]] = to_number(value)
+    return data
+
+
+def parse_kmerfinder_yaml(raw_data_dir):
+    yaml_file = os.path.join(raw_data_dir, "extra", "multiqc_kmerfinder.yaml")
+    if not os.path.exists(yaml_file):
+        return {}
+    return parse_yaml(yaml_file)
+
+
+## MultiQC data file names, and the parser building the same data from the tool outputs
+RAW_DATA_PARSERS = {
+    "multiqc_fastp.yaml": parse_fastp_jsons,
+    "multiqc_nanostat.yaml": parse_nanostat_txts,
+    "multiqc_quast.yaml": parse_quast_reports,
+    "multiqc_kmerfinder.yaml": parse_kmerfinder_yaml,
+}
+
+
+# Build the data of a MultiQC YAML file from the tool outputs in its directory.
+# Returns None when there is none of them
+def load_raw_data(yaml_file):
+    parse = RAW_DATA_PARSERS[os.path.basename(yaml_file)]
+    data = parse_once(
+        yaml_file, lambda _: parse(os.path.dirname(yaml_file) or os.curdir)
+    )
+    return data or None
+
+
+# Index of every key in a dictionary created from YAML file to its first value
+# found recursively, a dictionary's own keys before those of its nested
+# dictionaries, so that each lookup is direct
+def index_tags(d):
+    index = {}
+
+    def walk(node):
+        for k, v in node.items():
+            index.setdefault(k, v)
+        for v in node.values():
+            if isinstance(v, dict):
+                walk(v)
+
+    walk(d)
+    return index
 
 
 def yaml_fields_to_dict(
-    yaml_file, append_dict={}, field_mapping_list=[], valid_sample_list=[]
+    yaml_file,
+    append_dict={},
+    field_mapping_list=[],
+    valid_sample_list=[],
+    load=load_data_file,
 ):
     integer_fields = [
         "# contigs",
         "# contigs (>= 5000 bp)",
         "Largest contig",
     ]
-    if os.path.exists(yaml_file):
-        with open(yaml_file) as f:
-            yaml_dict = yaml.safe_load(f)
-            for k in yaml_dict.keys():
-                key = k
-                include_sample = True
-                if len(valid_sample_list) != 0 and key not in valid_sample_list:
-                    include_sample = False
-                if include_sample:
-                    if key not in append_dict:
-                        append_dict[key] = {}
-                    if field_mapping_list != []:
-                        for i, j in field_mapping_list:
-                            val = list(find_tag(yaml_dict[k], j[0]))
-                            ## Fix for Cutadapt reporting reads/pairs as separate values
-                            if j[0] == "r_written" and len(val) == 0:
-                                val = [
-                                    list(find_tag(yaml_dict[k], "pairs_written"))[0] * 2
-                                ]
-                            if len(val) != 0:
-                                val = val[0]
-                                if len(j) == 2:
-                                    val = list(find_tag(val, j[1]))[0]
-                                if j[0] in integer_fields:
-                                    val = int(val)
-                                if i not in append_dict[key]:
-                                    append_dict[key][i] = val
-                                else:
-                                    print(
-                                        "WARNING: {} key already exists in dictionary so will be overwritten. YAML file {}.".format(
-                                            i, yaml_file
-                                        )
+    yaml_dict = load(yaml_file)
+    if yaml_dict is not None:
+        for k in yaml_dict.keys():
+            key = k
+            include_sample = True
+            if len(valid_sample_list) != 0 and key not in valid_sample_list:
+                include_sample = False
+            if include_sample:
+                if key not in append_dict:
+                    append_dict[key] = {}
+                if field_mapping_list != []:
+                    tags = index_tags(yaml_dict[k])
+                    for i, j in field_mapping_list:
+                        val = [tags[j[0]]] if j[0] in tags else []
+                        ## Fix for Cutadapt reporting reads/pairs as separate values
+                        if j[0] == "r_written" and len(val) == 0:
+                            val = [tags["pairs_written"] * 2]
+                        if len(val) != 0:
+                            val = val[0]
+                            if len(j) == 2:
+                                val = index_tags(val)[j[1]]
+                            if j[0] in integer_fields:
+                                val = int(val)
+                            if i not in append_dict[key]:
+                                append_dict[key][i] = val
+                            else:
+                                print(
+                                    "WARNING: {} key already exists in dictionary so will be overwritten. YAML file {}.".format(
+                                        i, yaml_file
                                     )
-                    else:
-                        append_dict[key] = yaml_dict[k]
+                                )
+                else:
+                    append_dict[key] = yaml_dict[k]
     else:
         print("WARNING: File does not exist: {}".format(yaml_file))
         if len(valid_sample_list) != 0:
@@ -124,17 +337,24 @@ def yaml_fields_to_dict(
 
 
 def metrics_dict_to_file(
-    file_field_list, multiqc_data_dir, out_file, valid_sample_list=[]
+    file_field_list,
+    multiqc_data_dir,
+    out_file,
+    valid_sample_list=[],
+    load=load_data_file,
 ):
     metrics_dict = {}
     field_list = []
-    for yaml_file, mapping_list in file_field_list:
-        yaml_file = os.path.join(multiqc_data_dir, yaml_file)
+    yaml_files = [os.path.join(multiqc_data_dir, x[0]) for x in file_field_list]
+    with ThreadPoolExecutor(max(1, len(yaml_files))) as pool:
+        list(pool.map(load, yaml_files))
+    for yaml_file, (_, mapping_list) in zip(yaml_files, file_field_list):
         metrics_dict = yaml_fields_to_dict(
             yaml_file=yaml_file,
             append_dict=metrics_dict,
             field_mapping_list=mapping_list,
             valid_sample_list=valid_sample_list,
+            load=load,
         )
         field_list += [x[0] for x in mapping_list]
 
@@ -303,29 +523,40 @@ def main(args=None):
         ),
     ]
 
+    ## Read the tool outputs directly, or the data of a previous MultiQC run
+    data_dir = args.MULTIQC_DATA_DIR
+    load = load_data_file
+    if args.RAW_DATA_DIR is not None:
+        data_dir = args.RAW_DATA_DIR
+        load = load_raw_data
+
     ## Write de novo assembly metrics to file
-    if args.ASSEMBLY_TYPE == "short":
-        metrics_dict_to_file(
-            file_field_list=illumina_assembly_files,
-            multiqc_data_dir=args.MULTIQC_DATA_DIR,
-            out_file=args.OUT_PREFIX + "_assembly_metrics_mqc.csv",
-            valid_sample_list=[],
-        )
-    elif args.ASSEMBLY_TYPE == "long":
-        metrics_dict_to_file(
-            file_field_list=nanopore_assembly_files,
-            multiqc_data_dir=args.MULTIQC_DATA_DIR,
-            out_file=args.OUT_PREFIX + "_assembly_metrics_mqc.csv",
-            valid_sample_list=[],
-        )
-    elif args.ASSEMBLY_TYPE == "hybrid":
-        metrics_dict_to_file(
-            file_field_list=hybrid_assembly_files,
-            multiqc_data_dir=args.MULTIQC_DATA_DIR,
+    file_field_list = {
+        "short": illumina_assembly_files,
+        "long": nanopore_assembly_files,
+        "hybrid": hybrid_assembly_files,
+    }.get(args.ASSEMBLY_TYPE)
+    if file_field_list is not None:
+        metrics_dict = metrics_dict_to_file(
+            file_field_list=file_field_list,
+            multiqc_data_dir=data_dir,
             out_file=args.OUT_PREFIX + "_assembly_metrics_mqc.csv",
             valid_sample_list=[],
+            load=load,
         )
 
+        ## Keep the metrics of this run across runs
+        if args.METRICS_DB and metrics_dict != {}:
+            run_date = args.RUN_DATE or date.today().isoformat()
+            upsert_metrics(
+                db_file=args.METRICS_DB,
+                metrics_dict=metrics_dict,
+                file_field_list=file_field_list,
+                run_id=args.RUN_ID or run_date,
+                run_date=run_date,
+                assembly_type=args.ASSEMBLY_TYPE,
+            )
+
 
 if __name__ == "__main__":
     sys.exit(main())
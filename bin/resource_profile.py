@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+"""
+Requested versus peak resources of the tasks of a Nextflow trace, per process
+and per label of conf/base.config, as MultiQC custom content tables.
+
+Run inside the pipeline by RESOURCE_PROFILE on the trace of the tasks done so
+far, and by the Latch runtime (through wf/resource_report.py) on the full
+trace once the run ends.
+"""
+
+import argparse
+import sys
+import csv
+import json
+import re
+from pathlib import Path
+from typing import Dict, List, Optional
+
+_memory_units = {
+    "B": 1,
+    "KB": 1024,
+    "MB": 1024**2,
+    "GB": 1024**3,
+    "TB": 1024**4,
+    "PB": 1024**5,
+}
+_duration_units = {"ms": 0.001, "s": 1, "m": 60, "h": 3600, "d": 86400}
+
+
+def parse_memory(value: str) -> Optional[float]:
+    """Bytes of a trace memory value ("1.5 GB", or raw bytes)"""
+    value = value.strip()
+    if value in ("", "-"):
+        return None
+    parts = value.split()
+    try:
+        if len(parts) == 2:
+            return float(parts[0]) * _memory_units[parts[1].upper()]
+        return float(value)
+    except (KeyError, ValueError):
+        return None
+
+
+def parse_duration(value: str) -> Optional[float]:
+    """Seconds of a trace duration value ("1h 2m 3s", "450ms", or raw ms)"""
+    value = value.strip()
+    if value in ("", "-"):
+        return None
+    try:
+        return float(value) / 1000
+    except ValueError:
+        pass
+    parts = re.findall(r"([\d.]+)(ms|s|m|h|d)", value)
+    if not parts:
+        return None
+    return sum(float(n) * _duration_units[u] for n, u in parts)
+
+
+def parse_number(value: str) -> Optional[float]:
+    value = value.strip().rstrip("%")
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+def process_labels(project_dir: Path) -> Dict[str, List[str]]:
+    """Labels of every process of the pipeline, by name and include alias"""
+    labels: Dict[str, List[str]] = {}
+    aliases: Dict[str, str] = {}
+    # only the pipeline sources, the project dir is also the Nextflow workdir
+    nf_files = [project_dir / "main.nf"]
+    for subdir in ["workflows", "subworkflows", "modules"]:
+        nf_files.extend((project_dir / subdir).glob("**/*.nf"))
+    for nf in nf_files:
+        text = nf.read_text(errors="replace")
+        for block in re.split(r"(?m)^\s*process\s+", text)[1:]:
+            name = re.match(r"(\w+)", block)
+            if name is None:
+                continue
+            body = block.split("script:", 1)[0]
+            labels[name.group(1)] = re.findall(r"(?m)^\s*label\s+['\"](\w+)['\"]", body)
+        for include in re.findall(r"include\s*\{([^}]*)\}", text):
+            for item in include.split(";"):
+                m = re.match(r"\s*(\w+)\s+as\s+(\w+)\s*$", item)
+                if m:
+                    aliases[m.group(2)] = m.group(1)
+    for alias, name in aliases.items():
+        labels.setdefault(alias, labels.get(name, []))
+    return labels
+
+
+def read_trace(trace_file: Path) -> List[Dict[str, Optional[float]]]:
+    """Resource usage of the completed, cached and failed tasks of a trace file"""
+    tasks = []
+    with open(trace_file, newline="") as f:
+        for row in csv.DictReader(f, delimiter="\t"):
+            if row.get("status") not in ("COMPLETED", "FAILED", "CACHED"):
+                continue
+            process = row.get("process") or row.get("name", "").split(" (")[0]
+            tag = row.get("tag")
+            if not tag or tag == "-":
+                tag = re.search(r"\((.*)\)$", row.get("name", ""))
+                tag = tag and tag.group(1)
+            tasks.append(
+                {
+                    "process": process.split(":")[-1],
+                    "status": row.get("status"),
+                    "tag": tag,
+                    "exit": row.get("exit"),
+                    "cpus": parse_number(row.get("cpus", "")),
+                    "memory": parse_memory(row.get("memory", "")),
+                    "pct_cpu": parse_number(row.get("%cpu", "")),
+                    "peak_rss": parse_memory(row.get("peak_rss", "")),
+                    "rchar": parse_memory(row.get("rchar", "")),
+                    "wchar": parse_memory(row.get("wchar", "")),
+                    "realtime": parse_duration(row.get("realtime", "")),
+                }
+            )
+    return tasks
+
+
+def _summarize(tasks: List[Dict]) -> Dict[str, float]:
+    def values(key: str) -> List[float]:
+        return [t[key] for t in tasks if t[key] is not None]
+
+    def peak(key: str) -> Optional[float]:
+        v = values(key)
+        return max(v) if v else None
+
+    summary = {
+        "tasks": len(tasks),
+        "failed": sum(t["status"] == "FAILED" for t in tasks),
+        "req_cpus": peak("cpus"),
+        "peak_cpus": None if peak("pct_cpu") is None else peak("pct_cpu") / 100,
+        "req_mem_gb": None if peak("memory") is None else peak("memory") / 1024**3,
+        "peak_rss_gb": (
+            None if peak("peak_rss") is None else peak("peak_rss") / 1024**3
+        ),
+        "read_gb": sum(values("rchar")) / 1024**3,
+        "written_gb": sum(values("wchar")) / 1024**3,
+        "max_realtime_min": (
+            None if peak("realtime") is None else peak("realtime") / 60
+        ),
+        "total_realtime_min": sum(values("realtime")) / 60,
+    }
+    if summary["req_cpus"] and summary["peak_cpus"] is not None:
+        summary["cpu_usage_pct"] = 100 * summary["peak_cpus"] / summary["req_cpus"]
+    if summary["req_mem_gb"] and summary["peak_rss_gb"] is not None:
+        summary["mem_usage_pct"] = 100 * summary["peak_rss_gb"] / summary["req_mem_gb"]
+    return {k: round(v, 2) if isinstance(v, float) else v for k, v in summary.items()}
+
+
+def resource_profile(
+    trace_file: Path, project_dir: Path
+) -> Dict[str, Dict[str, Dict[str, float]]]:
+    """Requested versus peak resources per process and per label"""
+    tasks = read_trace(trace_file)
+    labels = process_labels(project_dir)
+
+    by_process: Dict[str, List[Dict]] = {}
+    by_label: Dict[str, List[Dict]] = {}
+    for task in tasks:
+        by_process.setdefault(task["process"], []).append(task)
+        for label in labels.get(task["process"]) or ["(no label)"]:
+            by_label.setdefault(label, []).append(task)
+
+    return {
+        "process": {k: _summarize(v) for k, v in sorted(by_process.items())},
+        "label": {k: _summarize(v) for k, v in sorted(by_label.items())},
+    }
+
+
+_headers = {
+    "tasks": {"title": "Tasks", "format": "{:,.0f}"},
+    "failed": {"title": "Failed", "format": "{:,.0f}"},
+    "req_cpus": {"title": "CPUs requested", "description": "Largest request"},
+    "peak_cpus": {"title": "CPUs used", "description": "Peak %cpu / 100"},
+    "cpu_usage_pct": {
+        "title": "CPU usage",
+        "description": "Peak CPUs used over CPUs requested",
+        "suffix": "%",
+        "max": 100,
+    },
+    "req_mem_gb": {"title": "Memory requested (GB)", "description": "Largest request"},
+    "peak_rss_gb": {"title": "Peak RSS (GB)"},
+    "mem_usage_pct": {
+        "title": "Memory usage",
+        "description": "Peak RSS over memory requested",
+        "suffix": "%",
+        "max": 100,
+    },
+    "read_gb": {"title": "Read (GB)", "description": "Total rchar"},
+    "written_gb": {"title": "Written (GB)", "description": "Total wchar"},
+    "max_realtime_min": {"title": "Longest task (min)"},
+    "total_realtime_min": {"title": "Total task time (min)"},
+}
+
+
+def write_resource_profile(
+    profile: Dict[str, Dict[str, Dict[str, float]]], out_dir: Path
+) -> List[Path]:
+    """Writes one MultiQC custom content table per grouping"""
+    files = []
+    for group, data in profile.items():
+        content = {
+            "id": f"resource_profile_{group}",
+            "section_name": f"Resource usage per {group}",
+            "description": f"Requested versus peak resources of the tasks of each {group}, from the Nextflow trace.",
+            "plot_type": "table",
+            "pconfig": {
+                "id": f"resource_profile_{group}_table",
+                "title": f"Resource usage per {group}",
+            },
+            "headers": _headers,
+            "data": data,
+        }
+        path = out_dir / f"resource_profile_{group}_mqc.json"
+        with open(path, "w") as f:
+            json.dump(content, f, indent=4)
+        files.append(path)
+    return files
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(
+        description="Summarise a Nextflow trace per process and per label as MultiQC custom content."
+    )
+    parser.add_argument("--trace", type=Path, required=True, help="Nextflow trace file")
+    parser.add_argument(
+        "--project_dir",
+        type=Path,
+        default=Path("."),
+        help="Directory with the pipeline sources (main.nf, workflows, subworkflows, modules), read for the process labels",
+    )
+    parser.add_argument(
+        "--out_dir",
+        type=Path,
+        default=Path("."),
+        help="Directory the resource_profile_*_mqc.json tables are written to",
+    )
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    args = parse_args(args)
+    profile = resource_profile(args.trace, args.project_dir)
+    for path in write_resource_profile(profile, args.out_dir):
+        print(f"Wrote {path}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
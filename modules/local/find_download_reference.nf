@@ -8,29 +8,42 @@ process FIND_DOWNLOAD_REFERENCE {
         'biocontainers/requests:2.26.0' }"
 
     input:
-    tuple val(refmeta), path(reports,  stageAs: 'reports/*')
+    path(groups)                                    // file: one "species<TAB>report name" line per report
+    path(reports, stageAs: 'reports/*')
     path(ncbi_metadata_db)
 
     output:
-    tuple val(refmeta), path("*.fna.gz")              , emit: fna
-    tuple val(refmeta), path("*.gff.gz")              , emit: gff
-    tuple val(refmeta), path("*.faa.gz")              , emit: faa
-    tuple val(refmeta), path("references_found.tsv")  , emit: references_tsv
-    tuple val(refmeta), path("*.winner")              , emit: winner
-    path "versions.yml"                               , emit: versions
+    path("*/*.fna.gz")                , emit: fna
+    path("*/*.fna")                   , emit: fasta
+    path("*/*.fna.fai")               , emit: fai
+    path("*/*.gff.gz")                , emit: gff
+    path("*/*.faa.gz")                , emit: faa
+    path("*/references_found.tsv")    , emit: references_tsv
+    path("*/*.winner")                , emit: winner
+    path("*_mqc.json")                , emit: metrics
+    path "versions.yml"               , emit: versions
 
     script:
+    def args  = task.ext.args  ?: ''
+    def args2 = task.ext.args2 ?: ''
     """
-    ## Find the common reference genome
+    ## Find the common reference genome of every group
     find_common_reference.py \\
         -d reports/ \\
-        -o references_found.tsv
+        -o references_found.tsv \\
+        -batch $groups \\
+        -threads $task.cpus \\
+        $args2
 
-    ## Download the winner reference genome from the ncbi database
+    ## Download the winner reference genomes from the ncbi database, decompressing the genomes on the fly
     download_reference.py \\
-        -file references_found.tsv \\
+        -batch \\
+        -file */references_found.tsv \\
         -reference $ncbi_metadata_db \\
-        -out_dir .
+        -decompress \\
+        -metrics reference_download_mqc.json \\
+        -threads $task.cpus \\
+        $args
 
     cat <<-END_VERSIONS > versions.yml
     "${task.process}":
@@ -13,15 +13,14 @@ process KMERFINDER_SUMMARY {
     output:
     path "*.csv"        , emit: summary
     path "*.yaml"       , emit: yaml
+    path "kmerfinder_columns", emit: columns, optional: true
     path "versions.yml" , emit: versions
 
     script:
+    def args = task.ext.args ?: ''
     """
     ## summarizing kmerfinder results
-    kmerfinder_summary.py --path reports/ --output_bn kmerfinder.bn --output_csv kmerfinder_summary.csv
-
-    ## Create a yaml file from csv
-    csv_to_yaml.py -i kmerfinder_summary.csv -k 'sample_name' -op kmerfinder_summary
+    kmerfinder_summary.py --path reports/ --output_bn kmerfinder.bn --output_csv kmerfinder_summary.csv --output_yaml kmerfinder_summary.yaml --threads $task.cpus $args
 
     cat <<-END_VERSIONS > versions.yml
     "${task.process}":
@@ -34,27 +34,29 @@ process MULTIQC_CUSTOM {
 
     script:
     def args = task.ext.args ?: ''
+    def args2 = task.ext.args2 ?: ''
     def custom_config = multiqc_custom_config ? "--config $multiqc_custom_config" : ''
     """
-    ## Run MultiQC once to parse tool logs
-    multiqc -f $args $custom_config .
-
-    ## Collect additional files to be included in the report
-    if [ -d extra/ ]; then
-        cp extra/* multiqc_data/
-    fi
-
-    ## Create multiqc custom data
-    multiqc_to_custom_csv.py --assembly_type $params.assembly_type
+    ## Create multiqc custom data from the tool outputs
+    multiqc_to_custom_csv.py \\
+        --assembly_type $params.assembly_type \\
+        --raw_data_dir . \\
+        --run_id ${workflow.runName} \\
+        $args2
 
     ## Avoid the custom Multiqc table when the kmerfinder process is not invoked.
     if grep ">skip_kmerfinder<" workflow_summary_mqc.yaml; then
         rm *_assembly_metrics_mqc.csv
     fi
 
-    ## Run multiqc a second time
+    ## Run MultiQC once, including the custom table
     multiqc -f $args $custom_config .
 
+    ## Collect additional files to be included in the report data
+    if [ -d extra/ ]; then
+        cp extra/* multiqc_data/
+    fi
+
     cat <<-END_VERSIONS > versions.yml
     "${task.process}":
         multiqc: \$( multiqc --version | sed -e "s/multiqc, version //g" )
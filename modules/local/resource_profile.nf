@@ -0,0 +1,28 @@
+process RESOURCE_PROFILE {
+    tag "resource_profile"
+    label 'process_single'
+
+    conda "bioconda::multiqc=1.19"
+    container "${ workflow.containerEngine == 'singularity' && !task.ext.singularity_pull_docker_container ?
+        'https://depot.galaxyproject.org/singularity/multiqc:1.19--pyhdfd78af_0' :
+        'biocontainers/multiqc:1.19--pyhdfd78af_0' }"
+
+    input:
+    path(trace)                                     // file: trace of the running pipeline, tasks done so far
+    path(sources, stageAs: 'pipeline/*')            // main.nf and the workflows, subworkflows and modules dirs, for the process labels
+    val(ready)                                      // any value, emitted once the other tasks are done
+
+    output:
+    // no versions.yml: the task runs after the software versions are collated
+    path "*_mqc.json"   , emit: mqc
+
+    script:
+    def args = task.ext.args ?: ''
+    """
+    resource_profile.py \\
+        --trace $trace \\
+        --project_dir pipeline \\
+        --out_dir . \\
+        $args
+    """
+}
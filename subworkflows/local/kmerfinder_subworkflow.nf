@@ -53,23 +53,37 @@ workflow KMERFINDER_SUBWORKFLOW {
         .map{
             meta, report_json, report_txt, fasta ->
                 specie = report_json.splitJson(path:"kmerfinder.results.species_hits").value.get(0)["Species"]
-                return tuple(specie, meta, report_txt, fasta)
+                // Species names are used as directory names by FIND_DOWNLOAD_REFERENCE
+                return tuple(specie.replaceAll(/[^A-Za-z0-9_.-]/, '_'), meta, report_txt, fasta)
         }
         .groupTuple(by:0) // Group by the "Species" field
         .set { ch_reports_byreference }
 
-    // SUBWORKFLOW: For each species target, this subworkflow collects reference genome assemblies ('GCF*') and subsequently downloads the best matching reference assembly.
+    // SUBWORKFLOW: For every species target at once, this subworkflow collects reference genome assemblies ('GCF*') and subsequently downloads the best matching reference assembly.
+    ch_reports_byreference
+        .map{ specie, meta, report_txt, fasta -> report_txt.collect{ report -> "${specie}\t${report.name}\n" }.join() }
+        .collectFile(name: 'reference_groups.tsv', sort: true)
+        .set{ ch_reference_groups }
+
     FIND_DOWNLOAD_REFERENCE (
-        ch_reports_byreference.map{ specie, meta, report_txt, fasta-> tuple(specie, report_txt) },
+        ch_reference_groups,
+        ch_reports_byreference.map{ specie, meta, report_txt, fasta -> report_txt }.flatten().collect(),
         ch_ncbi_assembly_metadata
     )
+    ch_download_metrics = FIND_DOWNLOAD_REFERENCE.out.metrics
     ch_versions = ch_versions.mix(FIND_DOWNLOAD_REFERENCE.out.versions)
 
+    // Outputs are written to one directory per species, named as the "Species" field.
+    // The uncompressed genome spares QUAST from decompressing the reference for every run sharing it.
+    ch_reference_fna    = FIND_DOWNLOAD_REFERENCE.out.fasta.flatten().map{ fna -> tuple(fna.parent.name, fna) }
+    ch_reference_gff    = FIND_DOWNLOAD_REFERENCE.out.gff.flatten().map{ gff -> tuple(gff.parent.name, gff) }
+    ch_reference_winner = FIND_DOWNLOAD_REFERENCE.out.winner.flatten().map{ winner -> tuple(winner.parent.name, winner) }
+
     // Organize sample assemblies into channels based on their corresponding reference files.
     ch_reports_byreference
-        .join(FIND_DOWNLOAD_REFERENCE.out.fna)
-        .join(FIND_DOWNLOAD_REFERENCE.out.gff)
-        .join(FIND_DOWNLOAD_REFERENCE.out.winner)
+        .join(ch_reference_fna)
+        .join(ch_reference_gff)
+        .join(ch_reference_winner)
         .map {
             specie, meta, report_txt, fasta, fna, gff, winner_id ->
                 return tuple([id: winner_id.getBaseName()], meta, fasta, fna, gff)
@@ -79,5 +93,6 @@ workflow KMERFINDER_SUBWORKFLOW {
     emit:
     versions            = ch_versions               // channel: [ path(versions.yml) ]
     summary_yaml        = ch_summary_yaml           // channel: [ path(kmerfinder_summary.yml) ]
+    download_metrics    = ch_download_metrics       // channel: [ path(reference_download_mqc.json) ]
     consensus_byrefseq  = ch_consensus_byrefseq     // channel: [ refmeta, meta, fasta, fna, gff ]
 }
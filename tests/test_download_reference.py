@@ -0,0 +1,193 @@
+"""
+Tests of the download engine of bin/download_reference.py against a local
+HTTP stand-in for the NCBI FTP-over-HTTPS host
+"""
+
+import hashlib
+import importlib.util
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import pytest
+
+SCRIPT = Path(__file__).resolve().parents[1] / "bin" / "download_reference.py"
+spec = importlib.util.spec_from_file_location("download_reference", SCRIPT)
+download_reference = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(download_reference)
+
+PAYLOAD = os.urandom(256 * 1024)
+
+
+class StandIn(BaseHTTPRequestHandler):
+    """
+    Serves server.files, with Range support. Every request pops the next
+    fault of its path from server.faults: "unavailable" answers 503,
+    "truncate" drops the connection halfway, "corrupt" flips the first byte.
+    """
+
+    def do_GET(self):
+        self.server.requests.append((self.path, self.headers.get("Range")))
+        data = self.server.files.get(self.path)
+        if data is None:
+            self.send_error(404)
+            return
+        faults = self.server.faults.get(self.path, [])
+        fault = faults.pop(0) if faults else None
+        if fault == "unavailable":
+            self.send_error(503)
+            return
+        if fault == "corrupt":
+            data = bytes([data[0] ^ 0xFF]) + data[1:]
+
+        start = 0
+        if self.headers.get("Range"):
+            start = int(self.headers["Range"].split("=")[1].split("-")[0])
+            if start >= len(data):
+                self.send_response(416)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header(
+                "Content-Range", f"bytes {start}-{len(data) - 1}/{len(data)}"
+            )
+        else:
+            self.send_response(200)
+        body = data[start:]
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if fault == "truncate":
+            self.wfile.write(body[: len(body) // 2])
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), StandIn)
+    httpd.files = {"/genome.fna.gz": PAYLOAD}
+    httpd.faults = {}
+    httpd.requests = []
+    httpd.url = f"http://127.0.0.1:{httpd.server_address[1]}"
+    thread = threading.Thread(
+        target=httpd.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True
+    )
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def download(server, out_file, **kwargs):
+    with download_reference.make_session(2) as session:
+        return download_reference.download_file(
+            session,
+            server.url + "/genome.fna.gz",
+            str(out_file),
+            chunk_size=16 * 1024,
+            timeout=(5, 5),
+            backoff=0,
+            **kwargs,
+        )
+
+
+def test_download(server, tmp_path):
+    out_file = tmp_path / "genome.fna.gz"
+    metrics = download(server, out_file, md5=hashlib.md5(PAYLOAD).hexdigest())
+    assert out_file.read_bytes() == PAYLOAD
+    assert not os.path.exists(str(out_file) + ".part")
+    assert metrics["bytes"] == len(PAYLOAD)
+    assert metrics["retries"] == 0
+
+
+def test_resume_after_broken_transfer(server, tmp_path):
+    server.faults["/genome.fna.gz"] = ["truncate"]
+    out_file = tmp_path / "genome.fna.gz"
+    metrics = download(server, out_file, md5=hashlib.md5(PAYLOAD).hexdigest())
+    assert out_file.read_bytes() == PAYLOAD
+    assert metrics["retries"] == 1
+    # the second request only asks for what the first one did not deliver
+    (_, first_range), (_, second_range) = server.requests
+    assert first_range is None
+    assert second_range == f"bytes={len(PAYLOAD) // 2}-"
+    assert metrics["bytes"] == len(PAYLOAD)
+
+
+def test_resume_complete_part_file(server, tmp_path):
+    out_file = tmp_path / "genome.fna.gz"
+    Path(str(out_file) + ".part").write_bytes(PAYLOAD)
+    download(server, out_file)
+    assert out_file.read_bytes() == PAYLOAD
+    assert server.requests == [("/genome.fna.gz", f"bytes={len(PAYLOAD)}-")]
+
+
+def test_retry_transient_error(server, tmp_path):
+    server.faults["/genome.fna.gz"] = ["unavailable", "unavailable"]
+    out_file = tmp_path / "genome.fna.gz"
+    metrics = download(server, out_file)
+    assert out_file.read_bytes() == PAYLOAD
+    assert metrics["retries"] == 2
+
+
+def test_retries_exhausted(server, tmp_path):
+    server.faults["/genome.fna.gz"] = ["unavailable"] * 3
+    with pytest.raises(download_reference.requests.exceptions.HTTPError):
+        download(server, tmp_path / "genome.fna.gz", retries=2)
+    assert len(server.requests) == 3
+
+
+def test_missing_file_is_not_retried(server, tmp_path):
+    server.files = {}
+    with pytest.raises(download_reference.requests.exceptions.HTTPError):
+        download(server, tmp_path / "genome.fna.gz")
+    assert len(server.requests) == 1
+
+
+def test_md5_mismatch_restarts(server, tmp_path):
+    server.faults["/genome.fna.gz"] = ["corrupt"]
+    out_file = tmp_path / "genome.fna.gz"
+    metrics = download(server, out_file, md5=hashlib.md5(PAYLOAD).hexdigest())
+    assert out_file.read_bytes() == PAYLOAD
+    assert metrics["retries"] == 1
+    # the corrupted part file is discarded, not resumed
+    assert server.requests[1][1] is None
+
+
+def test_md5_failure(server, tmp_path):
+    server.faults["/genome.fna.gz"] = ["corrupt"] * 3
+    out_file = tmp_path / "genome.fna.gz"
+    with pytest.raises(IOError, match="md5 mismatch"):
+        download(server, out_file, md5=hashlib.md5(PAYLOAD).hexdigest(), retries=2)
+    assert not out_file.exists()
+    assert not os.path.exists(str(out_file) + ".part")
+
+
+def test_md5_checksums(server, tmp_path):
+    server.files["/md5checksums.txt"] = (
+        f"{hashlib.md5(PAYLOAD).hexdigest()}  ./genome.fna.gz\n".encode()
+    )
+    with download_reference.make_session(1) as session:
+        checksums = download_reference.fetch_md5_checksums(
+            session, server.url + "/genome", timeout=(5, 5)
+        )
+    assert checksums == {"genome.fna.gz": hashlib.md5(PAYLOAD).hexdigest()}
+
+
+def test_probe_error_drops_only_that_candidate():
+    def probe(url):
+        if url.startswith("/outside"):
+            raise ValueError(f"{url} is outside the mirror root")
+        return url.endswith("ok")
+
+    selected = download_reference.select_references(
+        [["/outside/a", "/genomes/ok"], ["/outside/b"], ["/genomes/no", "/genomes/ok"]],
+        probe,
+        threads=4,
+    )
+    assert selected == [1, None, 1]
@@ -1,6 +1,7 @@
 from pathlib import Path
 from typing import List, Optional
 
+from latch.resources.conditional import create_conditional_section
 from latch.resources.launch_plan import LaunchPlan
 from latch.resources.workflow import workflow
 from latch.types import metadata
@@ -17,7 +18,9 @@ from wf.entrypoint import (
     PolishMethod,
     SampleSheet,
     initialize,
-    nextflow_runtime,
+    nextflow_runtime_large,
+    nextflow_runtime_medium,
+    nextflow_runtime_small,
 )
 
 meta = Path("latch_metadata") / "__init__.py"
@@ -175,11 +178,14 @@ def nf_nf_core_bacass(
 
     """
 
-    pvc_name: str = initialize(run_name=run_name)
-    nextflow_runtime(
+    pvc_name, head_size, read_bytes = initialize(
+        run_name=run_name, input=input, assembly_type=assembly_type
+    )
+    runtime_inputs = dict(
         run_name=run_name,
         pvc_name=pvc_name,
         input=input,
+        read_bytes=read_bytes,
         outdir=outdir,
         email=email,
         fastp_args=fastp_args,
@@ -215,6 +221,15 @@ def nf_nf_core_bacass(
         multiqc_title=multiqc_title,
         multiqc_methods_description=multiqc_methods_description,
     )
+    (
+        create_conditional_section("nextflow_runtime_size")
+        .if_(head_size == "small")
+        .then(nextflow_runtime_small(**runtime_inputs))
+        .elif_(head_size == "medium")
+        .then(nextflow_runtime_medium(**runtime_inputs))
+        .else_()
+        .then(nextflow_runtime_large(**runtime_inputs))
+    )
 
 
 LaunchPlan(
@@ -0,0 +1,429 @@
+import argparse
+import json
+import math
+import re
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from wf.resource_report import process_labels, read_trace
+
+# run description uploaded next to each trace: start time, assembly type and
+# the read bytes and genome size of every sample, the features the fits use
+run_inputs_name = "run_inputs.json"
+
+# recent runs logged under the log root by assembly type, oldest first, so a
+# new run reads one file instead of listing the whole history
+history_index_name = "autotune_runs.json"
+max_history_runs = 50
+# seconds the history may take to fetch before the run starts untuned
+history_budget = 60
+
+# tasks killed for exceeding their memory needed more than they were given
+oom_exit_codes = {"137", "140"}
+
+min_tasks = 3
+memory_headroom = 1.1
+memory_floor = 512 * 1024**2
+cpu_headroom = 1.25
+# tasks using this share of their CPUs were held back by their allocation
+cpu_saturation = 0.9
+
+
+@dataclass
+class Observation:
+    # tasks of a single sample are described by its reads and genome size,
+    # the others (MULTIQC, KMERFINDER_SUMMARY...) by the reads of the run
+    per_sample: bool
+    read_bytes: float
+    genome_size: Optional[float]
+    cpus_needed: Optional[float]
+    memory_needed: Optional[float]
+
+
+@dataclass
+class Prediction:
+    # by task tag (the sample) for per sample processes, under None for the
+    # run wide value
+    cpus: Dict[Optional[str], int]
+    memory_mb: Dict[Optional[str], int]
+
+
+def parse_genome_size(value: Optional[str]) -> Optional[float]:
+    """Megabases of a samplesheet GenomeSize ("4.5m"), None when missing"""
+    match = re.fullmatch(r"\s*([\d.]+)\s*[mM]?\s*", value or "")
+    if match is None:
+        return None
+    try:
+        return float(match.group(1))
+    except ValueError:
+        return None
+
+
+def _solve(a: List[List[float]], b: List[float]) -> Optional[List[float]]:
+    # gaussian elimination with partial pivoting, None when singular
+    n = len(b)
+    m = [row[:] + [b[i]] for i, row in enumerate(a)]
+    for col in range(n):
+        pivot = max(range(col, n), key=lambda r: abs(m[r][col]))
+        if abs(m[pivot][col]) < 1e-12:
+            return None
+        m[col], m[pivot] = m[pivot], m[col]
+        for r in range(n):
+            if r != col:
+                f = m[r][col] / m[col][col]
+                m[r] = [x - f * y for x, y in zip(m[r], m[col])]
+    return [m[i][n] / m[i][i] for i in range(n)]
+
+
+def _fit(
+    xs: List[Tuple[float, ...]], ys: List[float]
+) -> Tuple[float, List[float], float]:
+    """Least squares intercept and non-negative slopes of ys over the
+    features xs, with the largest positive residual"""
+    k = len(xs[0])
+    # features are centred so the normal equations stay well conditioned
+    means = [sum(x[j] for x in xs) / len(xs) for j in range(k)]
+    mean_y = sum(ys) / len(ys)
+    active = list(range(k))
+    slopes = [0.0] * k
+    while active:
+        a = [
+            [sum((x[i] - means[i]) * (x[j] - means[j]) for x in xs) for j in active]
+            for i in active
+        ]
+        b = [
+            sum((x[i] - means[i]) * (y - mean_y) for x, y in zip(xs, ys))
+            for i in active
+        ]
+        solution = _solve(a, b)
+        if solution is None:
+            active.pop()
+            continue
+        negative = [j for j, s in zip(active, solution) if s < 0]
+        if not negative:
+            for j, s in zip(active, solution):
+                slopes[j] = s
+            break
+        # a feature can not lower the needs, refit without it
+        active.remove(negative[0])
+    intercept = mean_y - sum(s * m for s, m in zip(slopes, means))
+
+    def fitted(x):
+        return intercept + sum(s * v for s, v in zip(slopes, x))
+
+    residual = max(y - fitted(x) for x, y in zip(xs, ys))
+    return intercept, slopes, max(0.0, residual)
+
+
+def observations(
+    trace_file: Path, run_inputs_file: Path
+) -> Dict[str, List[Observation]]:
+    """Per process resource needs of one past run"""
+    with open(run_inputs_file) as f:
+        samples = json.load(f)["samples"]
+    run_read_bytes = sum(s["read_bytes"] for s in samples.values())
+
+    result: Dict[str, List[Observation]] = {}
+    for task in read_trace(trace_file):
+        # cached tasks repeat a task of an earlier run, already counted there
+        if task["status"] == "CACHED":
+            continue
+        memory_needed = task["peak_rss"]
+        if (
+            task["status"] == "FAILED"
+            and task["exit"] in oom_exit_codes
+            and task["memory"] is not None
+        ):
+            # killed at its limit: it needed at least half as much again
+            memory_needed = max(memory_needed or 0, task["memory"] * 1.5)
+        elif task["status"] == "FAILED":
+            continue
+        cpus_needed = None if task["pct_cpu"] is None else task["pct_cpu"] / 100
+        if (
+            cpus_needed is not None
+            and task["cpus"]
+            and cpus_needed >= task["cpus"] * cpu_saturation
+        ):
+            # held at its allocation: it could have used at least one more
+            cpus_needed = task["cpus"] + 1
+        sample = samples.get(task["tag"] or "")
+        if sample is None:
+            obs = Observation(False, run_read_bytes, None, cpus_needed, memory_needed)
+        else:
+            obs = Observation(
+                True,
+                sample["read_bytes"],
+                parse_genome_size(sample.get("genome_size")),
+                cpus_needed,
+                memory_needed,
+            )
+        result.setdefault(task["process"], []).append(obs)
+    return result
+
+
+def base_cpus(project_dir: Path) -> Dict[str, int]:
+    """CPUs conf/base.config gives the first attempt of every process"""
+    text = (project_dir / "conf" / "base.config").read_text()
+    cpus = r"cpus\s*=\s*\{\s*check_max\(\s*(\d+)"
+    default = re.search(cpus, text.split("withLabel", 1)[0])
+    default_cpus = int(default.group(1)) if default else 1
+    by_label = {}
+    for label, body in re.findall(r"withLabel:\s*(\w+)\s*\{([^}]*)\}", text):
+        match = re.search(cpus, body)
+        if match:
+            by_label[label] = int(match.group(1))
+    return {
+        process: max(
+            [by_label[label] for label in labels if label in by_label],
+            default=default_cpus,
+        )
+        for process, labels in process_labels(project_dir).items()
+    }
+
+
+def predict(
+    history: Dict[str, List[Observation]],
+    run_inputs: Dict,
+    base: Optional[Dict[str, int]] = None,
+) -> Dict[str, Prediction]:
+    """CPUs and memory of the first attempt of every process with enough
+    history, per sample for the processes run once per sample. CPUs never go
+    below base, the CPUs of the process in conf/base.config."""
+    base = base or {}
+    samples = run_inputs["samples"]
+    run_read_bytes = sum(s["read_bytes"] for s in samples.values())
+    genome_sizes = {
+        name: parse_genome_size(s.get("genome_size")) for name, s in samples.items()
+    }
+
+    predictions = {}
+    for process, obs in history.items():
+        per_sample = all(o.per_sample for o in obs)
+        if not per_sample:
+            obs = [o for o in obs if not o.per_sample]
+        mem = [o for o in obs if o.memory_needed]
+        cpu = [o for o in obs if o.cpus_needed]
+        if len(mem) < min_tasks or len(cpu) < min_tasks:
+            continue
+
+        # the genome size is only used when every sample, past and present,
+        # has one
+        with_genome = (
+            per_sample
+            and all(o.genome_size is not None for o in mem)
+            and all(g is not None for g in genome_sizes.values())
+        )
+
+        def features(read_bytes, genome_size):
+            return (read_bytes, genome_size) if with_genome else (read_bytes,)
+
+        intercept, slopes, residual = _fit(
+            [features(o.read_bytes, o.genome_size) for o in mem],
+            [o.memory_needed for o in mem],
+        )
+        cpu_intercept, cpu_slopes, cpu_residual = _fit(
+            [(o.read_bytes,) for o in cpu], [o.cpus_needed for o in cpu]
+        )
+
+        def memory_mb(read_bytes, genome_size) -> int:
+            x = features(read_bytes, genome_size)
+            memory = intercept + sum(s * v for s, v in zip(slopes, x)) + residual
+            return math.ceil(max(memory * memory_headroom, memory_floor) / 1024**2)
+
+        def cpus(read_bytes) -> int:
+            need = cpu_intercept + cpu_slopes[0] * read_bytes + cpu_residual
+            return max(base.get(process, 1), math.ceil(need * cpu_headroom))
+
+        if per_sample:
+            memory = {
+                name: memory_mb(s["read_bytes"], genome_sizes[name])
+                for name, s in samples.items()
+            }
+            cpu_by_tag = {name: cpus(s["read_bytes"]) for name, s in samples.items()}
+            # tasks tagged otherwise than by the sample get the largest need
+            memory[None] = max(memory.values(), default=memory_mb(0, 0))
+            cpu_by_tag[None] = max(cpu_by_tag.values(), default=cpus(0))
+        else:
+            memory = {None: memory_mb(run_read_bytes, None)}
+            cpu_by_tag = {None: cpus(run_read_bytes)}
+        predictions[process] = Prediction(cpus=cpu_by_tag, memory_mb=memory)
+    return predictions
+
+
+def _groovy_string(value: str) -> str:
+    return "'" + value.replace("\\", "\\\\").replace("'", "\\'") + "'"
+
+
+def _by_tag(values: Dict[Optional[str], int]) -> str:
+    # groovy expression of the value of the task's tag, the run wide one for
+    # the other tags
+    by_tag = sorted((t, v) for t, v in values.items() if t is not None)
+    if not by_tag:
+        return str(values[None])
+    tags = ", ".join(f"({_groovy_string(t)}): {v}" for t, v in by_tag)
+    return f"([ {tags} ][task.tag] ?: {values[None]})"
+
+
+def write_config(predictions: Dict[str, Prediction], config_file: Path) -> None:
+    """Nextflow config overriding the resources of the predicted processes"""
+    lines = [
+        "// Generated from the traces of previous runs, do not edit",
+        "process {",
+    ]
+    for process, p in sorted(predictions.items()):
+        lines += [
+            f"    withName: '{process}' {{",
+            f"        cpus   = {{ Math.min( {_by_tag(p.cpus)} * task.attempt, params.max_cpus as int ) }}",
+            f"        memory = {{ [ {_by_tag(p.memory_mb)}.MB * task.attempt, params.max_memory as nextflow.util.MemoryUnit ].min() }}",
+            "    }",
+        ]
+    lines.append("}")
+    config_file.write_text("\n".join(lines) + "\n")
+
+
+def load_history(
+    run_dirs: List[Path], assembly_type: str
+) -> Dict[str, List[Observation]]:
+    """Observations of the runs of assembly_type among the run directories
+    holding a trace and its run inputs"""
+    history: Dict[str, List[Observation]] = {}
+    for run_dir in run_dirs:
+        trace_file = run_dir / "trace.txt"
+        run_inputs_file = run_dir / run_inputs_name
+        if not (trace_file.exists() and run_inputs_file.exists()):
+            continue
+        try:
+            with open(run_inputs_file) as f:
+                if json.load(f).get("assembly_type") != assembly_type:
+                    continue
+            run_obs = observations(trace_file, run_inputs_file)
+        except (OSError, ValueError, KeyError, TypeError, AttributeError) as e:
+            print(f"Skipping history of {run_dir.name}: {e}")
+            continue
+        for process, obs in run_obs.items():
+            history.setdefault(process, []).extend(obs)
+    return history
+
+
+def record_run(log_root: str, run: str, run_inputs: Dict) -> None:
+    """Adds a run whose trace and run inputs were logged under run to the
+    history index of its assembly type"""
+    from latch.ldata.path import LPath
+    from latch_cli.utils import urljoins
+
+    remote = LPath(urljoins(log_root, history_index_name))
+    with tempfile.TemporaryDirectory() as tmp:
+        index_file = Path(tmp) / history_index_name
+        try:
+            remote.download(index_file)
+            with open(index_file) as f:
+                index = json.load(f)
+        except Exception:
+            index = {}
+        # runs finishing together may drop each other's entry, which only
+        # costs the next runs some history
+        runs = [
+            r for r in index.get(run_inputs["assembly_type"], []) if r["run"] != run
+        ]
+        runs.append({"run": run, "started": run_inputs["started"]})
+        runs.sort(key=lambda r: r["started"])
+        index[run_inputs["assembly_type"]] = runs[-max_history_runs:]
+        index_file.write_text(json.dumps(index, indent=2))
+        remote.upload_from(index_file)
+
+
+def download_history(log_root: str, dest: Path, assembly_type: str) -> List[Path]:
+    """Downloads the traces and run inputs of the recent runs of assembly_type
+    listed in the history index"""
+    from latch.ldata.path import LPath
+    from latch_cli.utils import urljoins
+
+    dest.mkdir(parents=True, exist_ok=True)
+    index_file = dest / history_index_name
+    try:
+        LPath(urljoins(log_root, history_index_name)).download(index_file)
+        with open(index_file) as f:
+            runs = json.load(f).get(assembly_type, [])[-max_history_runs:]
+    except Exception:
+        return []
+
+    def fetch(run: Dict) -> Optional[Path]:
+        run_dir = dest / run["run"]
+        run_dir.mkdir(parents=True, exist_ok=True)
+        try:
+            for name in [run_inputs_name, "trace.txt"]:
+                LPath(urljoins(log_root, run["run"], name)).download(run_dir / name)
+        except Exception:
+            return None
+        return run_dir
+
+    with ThreadPoolExecutor(max_workers=16) as pool:
+        return [run_dir for run_dir in pool.map(fetch, runs) if run_dir is not None]
+
+
+def tune_resources(
+    log_root: str, work_dir: Path, run_inputs: Dict, budget: float = history_budget
+) -> Optional[Path]:
+    """Config sizing the processes of a new run from the runs of the same
+    assembly type logged before it, None when there is not enough history or
+    it takes longer than budget seconds to fetch"""
+    assembly_type = run_inputs["assembly_type"]
+    history_dir = work_dir / "autotune_history"
+    pool = ThreadPoolExecutor(max_workers=1)
+    try:
+        run_dirs = pool.submit(
+            download_history, log_root, history_dir, assembly_type
+        ).result(timeout=budget)
+    except FutureTimeoutError:
+        print(f"Fetching the run history took over {budget}s, not tuning")
+        return None
+    finally:
+        pool.shutdown(wait=False)
+    history = load_history(run_dirs, assembly_type)
+    predictions = predict(history, run_inputs, base_cpus(work_dir))
+    if not predictions:
+        return None
+    config_file = work_dir / "autotune.config"
+    write_config(predictions, config_file)
+    return config_file
+
+
+def main(args=None) -> None:
+    parser = argparse.ArgumentParser(
+        description="Fit per process CPUs and memory from past Nextflow traces and write them as a config."
+    )
+    parser.add_argument(
+        "history",
+        type=Path,
+        nargs="+",
+        help=f"Run directories, each with a trace.txt and its {run_inputs_name}",
+    )
+    parser.add_argument(
+        "--run-inputs",
+        type=Path,
+        required=True,
+        help=f"{run_inputs_name} of the run to size",
+    )
+    parser.add_argument(
+        "--project-dir",
+        type=Path,
+        default=Path("."),
+        help="Pipeline whose conf/base.config gives the minimum CPUs",
+    )
+    parser.add_argument("--output", type=Path, default=Path("autotune.config"))
+    args = parser.parse_args(args)
+
+    with open(args.run_inputs) as f:
+        run_inputs = json.load(f)
+    history = load_history(args.history, run_inputs["assembly_type"])
+    predictions = predict(history, run_inputs, base_cpus(args.project_dir))
+    write_config(predictions, args.output)
+    print(f"Wrote {len(predictions)} process resource predictions to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
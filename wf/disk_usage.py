@@ -0,0 +1,69 @@
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from pathlib import Path
+from typing import List, Optional, Set, Tuple
+
+
+def disk_usage(
+    root: Path, workers: int = 32, budget: Optional[float] = None
+) -> Tuple[int, bool]:
+    """Apparent size in bytes of everything under root, like `du -sb`.
+
+    Directories are scanned concurrently with os.scandir, symlinks are not
+    followed, and files with several hardlinks are counted once. When budget
+    (seconds) runs out the scan stops and the bytes counted so far are
+    returned as a lower bound.
+
+    Returns the size and whether the whole tree was scanned.
+    """
+    deadline = None if budget is None else time.monotonic() + budget
+    seen: Set[Tuple[int, int]] = set()
+    seen_lock = threading.Lock()
+
+    def scan(path: str) -> Tuple[int, List[str]]:
+        size = 0
+        subdirs: List[str] = []
+        try:
+            with os.scandir(path) as it:
+                for entry in it:
+                    try:
+                        st = entry.stat(follow_symlinks=False)
+                        is_dir = entry.is_dir(follow_symlinks=False)
+                    except OSError:
+                        continue
+                    if is_dir:
+                        subdirs.append(entry.path)
+                    elif st.st_nlink > 1:
+                        key = (st.st_dev, st.st_ino)
+                        with seen_lock:
+                            if key in seen:
+                                continue
+                            seen.add(key)
+                    size += st.st_size
+        except OSError:
+            pass
+        return size, subdirs
+
+    total = os.lstat(root).st_size
+    complete = True
+    pool = ThreadPoolExecutor(max_workers=workers)
+    try:
+        pending: Set[Future] = {pool.submit(scan, str(root))}
+        while pending:
+            timeout = None
+            if deadline is not None:
+                timeout = max(0.0, deadline - time.monotonic())
+            done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            if not done:
+                complete = False
+                break
+            for future in done:
+                size, subdirs = future.result()
+                total += size
+                pending.update(pool.submit(scan, d) for d in subdirs)
+    finally:
+        pool.shutdown(wait=complete, cancel_futures=True)
+
+    return total, complete
@@ -1,11 +1,14 @@
 import csv
+import functools
+import inspect
+import json
 import os
-import shutil
 import subprocess
 import sys
 from dataclasses import dataclass
+from datetime import datetime, timezone
 from pathlib import Path
-from typing import List, Optional
+from typing import Dict, List, Optional, Tuple
 
 import requests
 from latch.executions import rename_current_execution, report_nextflow_used_storage
@@ -18,6 +21,8 @@ from latch_cli.nextflow.workflow import get_flag
 from latch_cli.services.register.utils import import_module_by_path
 from latch_cli.utils import urljoins
 
+from wf.autotune import record_run, run_inputs_name, tune_resources
+from wf.disk_usage import disk_usage
 from wf.enums import (
     AnnotationTool,
     Assembler,
@@ -26,6 +31,22 @@ from wf.enums import (
     CanuMode,
     PolishMethod,
 )
+from wf.head_sizing import (
+    choose_head_size,
+    default_head_size,
+    estimate_head_resources,
+    head_sizes,
+    nxf_opts,
+)
+from wf.preflight import (
+    RemoteStat,
+    fast5_column,
+    read_columns,
+    stat_remote,
+    validate_samplesheet,
+)
+from wf.resource_report import resource_profile, write_resource_profile
+from wf.staging import sync_project
 
 sys.stdout.reconfigure(line_buffering=True)
 
@@ -33,6 +54,8 @@ meta = Path("latch_metadata") / "__init__.py"
 import_module_by_path(meta)
 import latch_metadata
 
+log_root = "latch:///your_log_dir/nf_nf_core_bacass"
+
 
 @dataclass(frozen=True)
 class SampleSheet:
@@ -44,10 +67,58 @@ class SampleSheet:
     GenomeSize: Optional[str]
 
 
+def samplesheet_row(sample: SampleSheet) -> Dict[str, str]:
+    return {
+        "ID": sample.ID,
+        "R1": str(sample.R1.remote_path),
+        "R2": str(sample.R2.remote_path),
+        "LongFastQ": str(sample.LongFastQ.remote_path) if sample.LongFastQ else "NA",
+        "Fast5": str(sample.Fast5.remote_path) if sample.Fast5 else "NA",
+        "GenomeSize": str(sample.GenomeSize) if sample.GenomeSize else "NA",
+    }
+
+
+def custom_samplesheet_constructor(
+    samples: List[SampleSheet], shared_dir: Path
+) -> Path:
+    samplesheet = Path(shared_dir / "samplesheet.tsv")
+    columns = ["ID", "R1", "R2", "LongFastQ", "Fast5", "GenomeSize"]
+
+    with open(samplesheet, "w") as f:
+        writer = csv.DictWriter(f, columns, delimiter="\t")
+        writer.writeheader()
+
+        for sample in samples:
+            writer.writerow(samplesheet_row(sample))
+
+    return samplesheet
+
+
+def sample_read_bytes(
+    samples: List[SampleSheet], stats: Dict[str, Optional[RemoteStat]]
+) -> List[int]:
+    rows = [samplesheet_row(s) for s in samples]
+    return [
+        sum(stats[row[c]].size or 0 for c in read_columns if stats.get(row[c]))
+        for row in rows
+    ]
+
+
 @custom_task(cpu=0.25, memory=0.5, storage_gib=1)
-def initialize(run_name: str) -> str:
+def initialize(
+    run_name: str, input: List[SampleSheet], assembly_type: AssemblyType
+) -> Tuple[str, str, List[int]]:
     rename_current_execution(str(run_name))
 
+    print("Validating inputs... ", end="")
+    rows = [samplesheet_row(s) for s in input]
+    stats = stat_remote(row[c] for row in rows for c in [*read_columns, fast5_column])
+    errors = validate_samplesheet(rows, assembly_type.value, stats)
+    if errors:
+        print("Failed.")
+        raise ValueError("Invalid samplesheet:\n" + "\n".join(errors))
+    print(f"Done. Checked {len(rows)} samples and {len(stats)} paths")
+
     token = os.environ.get("FLYTE_INTERNAL_EXECUTION_ID")
     if token is None:
         raise RuntimeError("failed to get execution token")
@@ -66,40 +137,27 @@ def initialize(run_name: str) -> str:
     resp.raise_for_status()
     print("Done.")
 
-    return resp.json()["name"]
-
-
-def custom_samplesheet_constructor(
-    samples: List[SampleSheet], shared_dir: Path
-) -> Path:
-    samplesheet = Path(shared_dir / "samplesheet.tsv")
-    columns = ["ID", "R1", "R2", "LongFastQ", "Fast5", "GenomeSize"]
-
-    with open(samplesheet, "w") as f:
-        writer = csv.DictWriter(f, columns, delimiter="\t")
-        writer.writeheader()
+    print("Sizing the Nextflow runtime... ", end="")
+    try:
+        need = estimate_head_resources(len(input), assembly_type.value)
+        head_size = choose_head_size(need)
+        print(f"Done. Needs {need}, using {head_size} {head_sizes[head_size]}")
+    except Exception as e:
+        head_size = default_head_size
+        print(f"Failed, using {head_size} {head_sizes[head_size]}: {e}")
 
-        for sample in samples:
-            row_data = {
-                "ID": sample.ID,
-                "R1": str(sample.R1.remote_path),
-                "R2": str(sample.R2.remote_path),
-                "LongFastQ": str(sample.LongFastQ.remote_path)
-                if sample.LongFastQ
-                else "NA",
-                "Fast5": str(sample.Fast5.remote_path) if sample.Fast5 else "NA",
-                "GenomeSize": str(sample.GenomeSize) if sample.GenomeSize else "NA",
-            }
-            writer.writerow(row_data)
+    # the runtime reuses the sizes stat'ed here instead of listing the reads again
+    read_bytes = sample_read_bytes(input, stats)
 
-    return samplesheet
+    return resp.json()["name"], head_size, read_bytes
 
 
-@nextflow_runtime_task(cpu=4, memory=8, storage_gib=100)
 def nextflow_runtime(
     pvc_name: str,
+    head_size: str,
     run_name: str,
     input: List[SampleSheet],
+    read_bytes: List[int],
     outdir: LatchOutputDir,
     email: Optional[str],
     fastp_args: Optional[str],
@@ -152,13 +210,38 @@ def nextflow_runtime(
         "mambaforge",
     ]
 
-    shutil.copytree(
-        Path("/root"),
-        shared_dir,
-        ignore=lambda src, names: ignore_list,
-        ignore_dangling_symlinks=True,
-        dirs_exist_ok=True,
-    )
+    # the volume is new for every execution, only retries find files to skip
+    print("Staging project files... ", end="")
+    copied, unchanged, seconds = sync_project(Path("/root"), shared_dir, ignore_list)
+    print(f"Done in {seconds:.1f}s ({copied} copied, {unchanged} unchanged)")
+
+    # the trace is written next to the work dir, where the RESOURCE_PROFILE
+    # task can read it while the run goes on, and copied to the outdir after
+    trace_file = shared_dir / "trace.txt"
+    trace_timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+
+    run_inputs = shared_dir / run_inputs_name
+    config_files = ["latch.config"]
+    try:
+        run_inputs_data = {
+            "started": datetime.now(timezone.utc).isoformat(),
+            "assembly_type": assembly_type.value,
+            "samples": {
+                sample.ID: {"read_bytes": b, "genome_size": sample.GenomeSize}
+                for sample, b in zip(input, read_bytes)
+            },
+        }
+        run_inputs.write_text(json.dumps(run_inputs_data))
+
+        print("Tuning process resources from previous runs... ", end="")
+        autotune_config = tune_resources(log_root, shared_dir, run_inputs_data)
+        if autotune_config is None:
+            print("Skipped, not enough history.")
+        else:
+            config_files.append(str(autotune_config))
+            print(f"Done. Using {autotune_config.name}")
+    except Exception as e:
+        print(f"Failed to tune process resources: {e}")
 
     cmd = [
         "/root/nextflow",
@@ -168,11 +251,13 @@ def nextflow_runtime(
         str(shared_dir),
         "-profile",
         "docker",
-        "-c",
-        "latch.config",
+        *[arg for config in config_files for arg in ["-c", config]],
         "-resume",
+        "-with-trace",
+        str(trace_file),
         *get_flag("input", input_samplesheet),
         *get_flag("outdir", LatchOutputDir(f"{outdir.remote_path}/{run_name}")),
+        *get_flag("resource_profile_trace", trace_file),
         *get_flag("email", email),
         *get_flag("fastp_args", fastp_args),
         *get_flag("save_trimmed", save_trimmed),
@@ -218,7 +303,7 @@ def nextflow_runtime(
             **os.environ,
             "NXF_ANSI_LOG": "false",
             "NXF_HOME": "/root/.nextflow",
-            "NXF_OPTS": "-Xms1536M -Xmx6144M -XX:ActiveProcessorCount=4",
+            "NXF_OPTS": nxf_opts(head_sizes[head_size]),
             "NXF_DISABLE_CHECK_LATEST": "true",
             "NXF_ENABLE_VIRTUAL_THREADS": "false",
         }
@@ -233,42 +318,94 @@ def nextflow_runtime(
     finally:
         print()
 
+        name = _get_execution_name()
+        log_dir = None if name is None else urljoins(log_root, name)
+
         nextflow_log = shared_dir / ".nextflow.log"
         if nextflow_log.exists():
-            name = _get_execution_name()
-            if name is None:
+            if log_dir is None:
                 print("Skipping logs upload, failed to get execution name")
             else:
-                remote = LPath(
-                    urljoins(
-                        "latch:///your_log_dir/nf_nf_core_bacass", name, "nextflow.log"
-                    )
-                )
+                remote = LPath(urljoins(log_dir, "nextflow.log"))
                 print(f"Uploading .nextflow.log to {remote.path}")
                 remote.upload_from(nextflow_log)
 
-        print("Computing size of workdir... ", end="")
-        try:
-            result = subprocess.run(
-                ["du", "-sb", str(shared_dir)],
-                check=True,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True,
-                timeout=5 * 60,
+        if trace_file.exists():
+            # -with-trace replaces the trace nextflow.config writes to the outdir
+            remote = LPath(
+                urljoins(
+                    outdir.remote_path,
+                    run_name,
+                    "pipeline_info",
+                    f"execution_trace_{trace_timestamp}.txt",
+                )
             )
+            print(f"Uploading trace.txt to {remote.path}")
+            try:
+                remote.upload_from(trace_file)
+            except Exception as e:
+                print(f"Failed to upload the trace to the outdir: {e}")
 
-            size = int(result.stdout.split()[0])
+        if trace_file.exists() and log_dir is not None:
+            try:
+                profile = resource_profile(trace_file, shared_dir)
+                for path in [
+                    trace_file,
+                    *write_resource_profile(profile, shared_dir),
+                    *([run_inputs] if run_inputs.exists() else []),
+                ]:
+                    remote = LPath(urljoins(log_dir, path.name))
+                    print(f"Uploading {path.name} to {remote.path}")
+                    remote.upload_from(path)
+                if run_inputs.exists():
+                    record_run(log_root, name, json.loads(run_inputs.read_text()))
+            except Exception as e:
+                print(f"Failed to build the resource usage report: {e}")
+
+        print("Computing size of workdir... ", end="")
+        try:
+            size, complete = disk_usage(shared_dir, budget=5 * 60)
             report_nextflow_used_storage(size)
-            print(f"Done. Workdir size: {size / 1024 / 1024 / 1024: .2f} GiB")
-        except subprocess.TimeoutExpired:
-            print(
-                "Failed to compute storage size: Operation timed out after 5 minutes."
-            )
-        except subprocess.CalledProcessError as e:
-            print(f"Failed to compute storage size: {e.stderr}")
+            if complete:
+                print(f"Done. Workdir size: {size / 1024 / 1024 / 1024: .2f} GiB")
+            else:
+                print(
+                    "Timed out after 5 minutes. Workdir size is at least"
+                    f" {size / 1024 / 1024 / 1024: .2f} GiB"
+                )
         except Exception as e:
             print(f"Failed to compute storage size: {e}")
 
     if failed:
         sys.exit(1)
+
+
+def sized_nextflow_runtime(head_size: str):
+    """nextflow_runtime registered as a task with the resources of head_size.
+
+    nextflow_runtime_task only takes fixed resources, so the runtime is
+    registered once per head size. The task takes every parameter of
+    nextflow_runtime but head_size, which it fixes.
+    """
+    size = head_sizes[head_size]
+    signature = inspect.signature(nextflow_runtime)
+    params = [p for p in signature.parameters.values() if p.name != "head_size"]
+
+    @functools.wraps(nextflow_runtime)
+    def runtime(**kwargs) -> None:
+        nextflow_runtime(head_size=head_size, **kwargs)
+
+    runtime.__signature__ = signature.replace(parameters=params)
+    runtime.__annotations__ = {p.name: p.annotation for p in params}
+    runtime.__annotations__["return"] = signature.return_annotation
+    # flytekit loads the task back from the module attribute of this name
+    runtime.__name__ = runtime.__qualname__ = f"nextflow_runtime_{head_size}"
+    return nextflow_runtime_task(
+        cpu=size.cpu, memory=size.memory, storage_gib=size.storage_gib
+    )(runtime)
+
+
+# one task per head size, the workflow runs the one initialize chose
+nextflow_runtime_small = sized_nextflow_runtime("small")
+nextflow_runtime_medium = sized_nextflow_runtime("medium")
+nextflow_runtime_large = sized_nextflow_runtime("large")
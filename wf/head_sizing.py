@@ -0,0 +1,70 @@
+import math
+from dataclasses import dataclass
+from typing import Dict
+
+
+@dataclass(frozen=True)
+class HeadResources:
+    cpu: int
+    memory: int
+    storage_gib: int
+
+
+# the head only writes NXF_HOME (plugins and assets, a few hundred MB) and its
+# logs: the project, the work dir and the remote inputs Nextflow stages are all
+# on the shared volume, so its disk does not grow with the reads of the run
+head_storage_gib = 20
+
+# sizes the Nextflow head task is registered with, smallest first
+head_sizes: Dict[str, HeadResources] = {
+    "small": HeadResources(cpu=2, memory=4, storage_gib=head_storage_gib),
+    "medium": HeadResources(cpu=4, memory=8, storage_gib=head_storage_gib),
+    "large": HeadResources(cpu=8, memory=32, storage_gib=head_storage_gib),
+}
+default_head_size = "medium"
+
+# tasks the pipeline runs per sample, each held by the head JVM as a task
+# record, trace record and channel tuples until the run ends
+tasks_per_sample = {"short": 12, "long": 14, "hybrid": 20}
+heap_per_task_mb = 0.5
+heap_base_mb = 1024
+
+# share of the pod memory given to the heap, the rest is metaspace, threads
+# and the off-heap buffers of file staging
+heap_fraction = 0.75
+
+samples_per_cpu = 250
+
+
+def estimate_head_resources(samples: int, assembly_type: str) -> HeadResources:
+    """Head task needs of a run of `samples`"""
+    heap_mb = (
+        heap_base_mb + samples * tasks_per_sample[assembly_type] * heap_per_task_mb
+    )
+    return HeadResources(
+        cpu=2 + samples // samples_per_cpu,
+        memory=math.ceil(heap_mb / 1024 / heap_fraction),
+        storage_gib=head_storage_gib,
+    )
+
+
+def choose_head_size(need: HeadResources) -> str:
+    """Smallest registered head size covering need, the largest one otherwise"""
+    for name, size in head_sizes.items():
+        if (
+            size.cpu >= need.cpu
+            and size.memory >= need.memory
+            and size.storage_gib >= need.storage_gib
+        ):
+            return name
+    print(
+        f"Warning: the run needs {need}, more than the largest head size {name}"
+        f" {size}. Nextflow may run out of memory, consider splitting the samplesheet"
+    )
+    return name
+
+
+def nxf_opts(size: HeadResources) -> str:
+    """JVM options of a Nextflow head running with size"""
+    xmx = int(size.memory * 1024 * heap_fraction)
+    return f"-Xms{xmx // 4}M -Xmx{xmx}M -XX:ActiveProcessorCount={size.cpu}"
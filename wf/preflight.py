@@ -0,0 +1,132 @@
+import json
+import re
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional
+
+schema_input = Path("assets") / "schema_input.json"
+
+# samplesheet columns holding reads, by the assembly types that need them
+read_columns = {
+    "R1": {"short", "hybrid"},
+    "R2": {"short", "hybrid"},
+    "LongFastQ": {"long", "hybrid"},
+}
+fast5_column = "Fast5"
+
+
+@dataclass
+class RemoteStat:
+    exists: bool
+    is_dir: bool = False
+    size: Optional[int] = None
+    children: List[str] = field(default_factory=list)
+
+
+def _stat(path: str) -> Optional[RemoteStat]:
+    """Metadata of a Latch path, None for paths outside Latch Data"""
+    from latch.ldata.path import LPath
+    from latch.ldata.type import LatchPathError
+
+    if not path.startswith("latch://"):
+        return None
+    lpath = LPath(path)
+    try:
+        lpath.fetch_metadata()
+    except LatchPathError:
+        return RemoteStat(exists=False)
+    if not lpath.is_dir(load_if_missing=False):
+        return RemoteStat(exists=True, size=lpath.size(load_if_missing=False))
+    # children are listed with their paths, name() would fetch each one again
+    children = [p.path.rstrip("/").rsplit("/", 1)[-1] for p in lpath.iterdir()]
+    return RemoteStat(exists=True, is_dir=True, children=children)
+
+
+def stat_remote(
+    paths: Iterable[str], workers: int = 16
+) -> Dict[str, Optional[RemoteStat]]:
+    """Stats every distinct path on a bounded thread pool"""
+    paths = sorted(set(paths))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return dict(zip(paths, pool.map(_stat, paths)))
+
+
+def _matches(branch: Dict, value: str) -> bool:
+    # the subset of JSON schema used by assets/schema_input.json
+    if "pattern" in branch and re.search(branch["pattern"], value) is None:
+        return False
+    if "maxLength" in branch and len(value) > branch["maxLength"]:
+        return False
+    return True
+
+
+def validate_samplesheet(
+    rows: List[Dict[str, str]],
+    assembly_type: str,
+    stats: Dict[str, Optional[RemoteStat]],
+    schema_file: Path = schema_input,
+) -> List[str]:
+    """Problems of the samplesheet rows Nextflow would fail or drop samples on.
+
+    Rows hold the values written to the samplesheet, "NA" for missing ones.
+    Values are checked against the input schema (patterns, required, unique,
+    exists), then against what the assembly type reads: short reads for short
+    and hybrid, long reads for long and hybrid. Fast5 directories must hold a
+    sequencing_summary.txt or .fast5 files to build one from. Paths outside
+    Latch Data, which cannot be stat'ed here, are left to Nextflow.
+    """
+    with open(schema_file) as f:
+        item_schema = json.load(f)["items"]
+
+    errors = []
+    seen: Dict[str, Dict[str, int]] = {}
+    for i, row in enumerate(rows, start=1):
+        sample = f"Sample {i} ({row.get('ID') or 'no ID'})"
+        for column in item_schema.get("required", []):
+            if row.get(column) in (None, "", "NA"):
+                errors.append(f"{sample}: {column} is required")
+
+        for column, prop in item_schema["properties"].items():
+            value = row.get(column)
+            if value is None:
+                continue
+            branches = prop.get("anyOf", [prop])
+            if not any(_matches(b, value) for b in branches):
+                errors.append(f"{sample}: {prop.get('errorMessage', column)}")
+                continue
+            if prop.get("unique"):
+                seen.setdefault(column, {})
+                if value in seen[column]:
+                    errors.append(
+                        f"{sample}: {column} {value} is already used by sample {seen[column][value]}"
+                    )
+                seen[column].setdefault(value, i)
+            if value in ("", "NA") or not any(b.get("exists") for b in branches):
+                continue
+            stat = stats.get(value)
+            if stat is None:
+                continue
+            want_dir = any(b.get("format") == "directory-path" for b in branches)
+            if not stat.exists:
+                errors.append(f"{sample}: {column} {value} does not exist")
+            elif stat.is_dir != want_dir:
+                kind = "a directory" if want_dir else "a file"
+                errors.append(f"{sample}: {column} {value} is not {kind}")
+
+        for column, assembly_types in read_columns.items():
+            if assembly_type in assembly_types and row.get(column) in (None, "", "NA"):
+                errors.append(
+                    f"{sample}: {column} is required for {assembly_type} assemblies"
+                )
+
+        stat = stats.get(row.get(fast5_column, "NA"))
+        if stat is not None and stat.is_dir:
+            if "sequencing_summary.txt" not in stat.children and not any(
+                c.endswith(".fast5") for c in stat.children
+            ):
+                errors.append(
+                    f"{sample}: {fast5_column} {row[fast5_column]} has neither a"
+                    " sequencing_summary.txt nor .fast5 files"
+                )
+    return errors
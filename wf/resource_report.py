@@ -0,0 +1,14 @@
+import importlib.util
+from pathlib import Path
+
+# the trace parsing is shared with the pipeline, which runs it as
+# bin/resource_profile.py to put the profile in the MultiQC report
+_script = Path(__file__).resolve().parents[1] / "bin" / "resource_profile.py"
+_spec = importlib.util.spec_from_file_location("resource_profile", _script)
+_resource_profile = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(_resource_profile)
+
+process_labels = _resource_profile.process_labels
+read_trace = _resource_profile.read_trace
+resource_profile = _resource_profile.resource_profile
+write_resource_profile = _resource_profile.write_resource_profile
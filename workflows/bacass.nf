@@ -33,6 +33,7 @@ include { MEDAKA                    } from '../modules/local/medaka'
 include { KRAKEN2_DB_PREPARATION    } from '../modules/local/kraken2_db_preparation'
 include { DFAST                     } from '../modules/local/dfast'
 include { MULTIQC_CUSTOM            } from '../modules/local/multiqc_custom'
+include { RESOURCE_PROFILE          } from '../modules/local/resource_profile'
 
 //
 // SUBWORKFLOW: Consisting of a mix of local and nf-core/modules
@@ -383,6 +384,7 @@ workflow BACASS {
     // Executes both kmerfinder and classifies samples by their reference genome (all this through the kmerfinder_subworkflow()).
 
     ch_kmerfinder_multiqc = Channel.empty()
+    ch_reference_download_multiqc = Channel.empty()
     if (!params.skip_kmerfinder) {
         // Set kmerfinder channel based on assembly type
         if( params.assembly_type == 'short' || params.assembly_type == 'hybrid' ) {
@@ -395,9 +397,10 @@ workflow BACASS {
             ch_for_kmerfinder,
             ch_assembly
         )
-        ch_kmerfinder_multiqc   = KMERFINDER_SUBWORKFLOW.out.summary_yaml
-        ch_consensus_byrefseq   = KMERFINDER_SUBWORKFLOW.out.consensus_byrefseq
-        ch_versions             = ch_versions.mix(KMERFINDER_SUBWORKFLOW.out.versions)
+        ch_kmerfinder_multiqc           = KMERFINDER_SUBWORKFLOW.out.summary_yaml
+        ch_reference_download_multiqc   = KMERFINDER_SUBWORKFLOW.out.download_metrics
+        ch_consensus_byrefseq           = KMERFINDER_SUBWORKFLOW.out.consensus_byrefseq
+        ch_versions                     = ch_versions.mix(KMERFINDER_SUBWORKFLOW.out.versions)
 
         // Set channel to perform by refseq QUAST based on reference genome identified with KMERFINDER.
         ch_consensus_byrefseq
@@ -509,6 +512,19 @@ workflow BACASS {
             newLine: true
         ).set { ch_collated_versions }
 
+    //
+    // MODULE: Requested versus used resources of the tasks run so far, from the live trace
+    //
+    ch_resource_profile_multiqc = Channel.empty()
+    if (params.resource_profile_trace) {
+        RESOURCE_PROFILE (
+            Channel.fromPath(params.resource_profile_trace),
+            Channel.fromPath(["$projectDir/main.nf", "$projectDir/workflows", "$projectDir/subworkflows", "$projectDir/modules"]).collect(),
+            ch_collated_versions
+        )
+        ch_resource_profile_multiqc = RESOURCE_PROFILE.out.mqc
+    }
+
     //
     // MODULE: MultiQC
     //
@@ -536,7 +552,7 @@ workflow BACASS {
         ch_quast_multiqc.collect{it[1]}.ifEmpty([]),
         ch_prokka_txt_multiqc.collect().ifEmpty([]),
         ch_bakta_txt_multiqc.collect().ifEmpty([]),
-        ch_kmerfinder_multiqc.collectFile(name: 'multiqc_kmerfinder.yaml').ifEmpty([]),
+        ch_kmerfinder_multiqc.collectFile(name: 'multiqc_kmerfinder.yaml').mix(ch_reference_download_multiqc).mix(ch_resource_profile_multiqc).collect().ifEmpty([]),
     )
     multiqc_report = MULTIQC_CUSTOM.out.report.toList()
 